@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+import threading
+from collections import deque
+
+class AccessLog:
+    """ Structured access log written as JSON Lines by a background thread.
+
+    The loop only appends a tuple to a bounded ring; formatting and writing
+    happen in batches on the writer thread. When the ring is full, records
+    are dropped and counted rather than blocking the loop. A log replaced
+    by a reload is retired: it stays open until the records it handed out
+    for responses still being sent are in. """
+    fields = ("time", "fd", "method", "path", "status", "bytes", "duration", "cache_hit")
+
+    def __init__(self, path, capacity, interval=0.5):
+        self.path = path
+        self.capacity = capacity
+        self.interval = interval
+        self.records = deque()
+        self.dropped = 0
+        self.written = 0
+        # records handed out by new_record and not yet added or discarded
+        self.outstanding = 0
+        self.retired = False
+        self.stopping = threading.Event()
+        self.thread = None
+        self.fd = None
+
+    def open(self):
+        """ Open the file, raising OSError if it can't be written """
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def start(self):
+        # started from the loop, so each forked worker gets its own writer
+        if self.fd is None:
+            self.open()
+        self.thread = threading.Thread(target=self.run, name="access-log")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def new_record(self, started, fd, method, path, status, cache_hit):
+        """ A record whose size and duration are filled in once the
+        response has been sent. It ends with this log, which is where it
+        goes even if a reload has replaced the log by then. """
+        self.outstanding += 1
+        return [started, fd, method, path, status, None, None, cache_hit, self]
+
+    def add(self, record):
+        self.outstanding -= 1
+        if len(self.records) >= self.capacity:
+            self.dropped += 1
+        else:
+            self.records.append(record)
+        if self.retired and not self.outstanding:
+            self.stop()
+
+    def discard(self, record):
+        """ For a response that was never sent in full """
+        self.outstanding -= 1
+        if self.retired and not self.outstanding:
+            self.stop()
+
+    def retire(self):
+        """ Stop once the records already handed out are in """
+        self.retired = True
+        if not self.outstanding:
+            self.stop()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.flush()
+        self.flush()
+        os.close(self.fd)
+
+    def flush(self):
+        lines = []
+        while self.records:
+            record = self.records.popleft()
+            try:
+                lines.append(json.dumps(dict(zip(self.fields, record))))
+            except ValueError:
+                # e.g. a path that isn't valid UTF-8
+                self.dropped += 1
+        if not lines:
+            return
+        try:
+            # one write per batch, so lines from several workers don't interleave
+            os.write(self.fd, ("\n".join(lines) + "\n").encode("utf-8"))
+            self.written += len(lines)
+        except OSError as err:
+            logging.error("Could not write access log %s: %s" % (self.path, err))
+
+    def stop(self):
+        """ Have the writer write what is left, close the file and exit,
+        without waiting for it """
+        self.stopping.set()
+
+    def close(self):
+        """ Stop and wait for the writer, e.g. on shutdown """
+        if self.thread:
+            self.stop()
+            self.thread.join()
+            self.thread = None
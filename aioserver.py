@@ -0,0 +1,361 @@
+import asyncio
+import signal
+import time
+from collections import deque
+
+from connection import FIRST_BYTE, WRITE
+
+from outqueue import FileSegment, Producer
+from poller import Poller
+from reqbuffer import RequestBuffer, RequestError
+
+class HttpProtocol(asyncio.Protocol):
+    """ One client connection on the asyncio engine """
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.sock = None
+        self.fd = None
+        self.ip = None
+        # turned away by the connection caps, never counted against them
+        self.refused = False
+        self.buffer = RequestBuffer(server.size, server.max_header, server.max_body)
+        self.parser = None
+        # (parts, start time, log record) waiting to be written in order
+        self.responses = deque()
+        self.sending = None
+        # waiting for a pool to make a producer's next buffer
+        self.stalled = False
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.closing = False
+        # request parked on the disk or WSGI pool, later requests wait behind it
+        self.waiting = None
+        self.deadline = 0
+        self.phase = None
+        self.phase_requests = 0
+        self.timer = None
+        self.requests = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.sock = transport.get_extra_info("socket")
+        self.fd = self.sock.fileno()
+        self.server.metrics.accepts += 1
+        peer = transport.get_extra_info("peername")
+        self.ip = peer[0] if peer else ""
+        refused = self.server.admit_connection(self.ip)
+        if refused:
+            self.refused = True
+            self.server.metrics.add_shed(refused)
+            transport.write(self.server.gen_busy("503 Service Unavailable", self.server.retry_after)[0])
+            transport.close()
+            return
+        self.server.protocols[self.fd] = self
+        transport.set_write_buffer_limits(high=self.server.write_high_water)
+        # asyncio turns on TCP_NODELAY itself, this applies tcp_nodelay
+        self.server.tune_client(self.sock)
+        self.set_deadline(FIRST_BYTE, self.server.first_byte_timeout)
+
+    def connection_lost(self, exc):
+        if self.refused:
+            return
+        self.server.release_connection(self.ip)
+        # the fd may already belong to a new connection
+        if self.server.protocols.get(self.fd) is self:
+            del self.server.protocols[self.fd]
+        if self.timer:
+            self.timer.cancel()
+        if self.sending:
+            self.sending.cancel()
+        for parts, started, record in self.responses:
+            self.server.close_parts(parts)
+            self.server.discard_record(record)
+        self.responses.clear()
+        self.writable.set()
+
+    def set_deadline(self, phase, timeout):
+        """ A later deadline only moves the timer when it fires, so pushing
+        it back costs no more than a clock read """
+        loop = self.server.loop
+        self.phase = phase
+        self.phase_requests = self.requests
+        self.deadline = loop.time() + timeout
+        if self.timer is not None and self.deadline < self.timer.when():
+            self.timer.cancel()
+            self.timer = None
+        if self.timer is None:
+            self.timer = loop.call_at(self.deadline, self.expire)
+
+    def reading(self):
+        """ Set the deadline for what the client is expected to send next """
+        if self.sending or not self.writable.is_set() or self.closing or self.waiting is not None:
+            return
+        deadline = self.server.read_deadline(self.buffer, self.requests, self.phase, self.phase_requests)
+        if deadline:
+            self.set_deadline(*deadline)
+
+    def writing(self):
+        if self.phase != WRITE:
+            self.set_deadline(WRITE, self.server.write_timeout)
+
+    def expire(self):
+        self.timer = None
+        if self.waiting is not None or self.stalled:
+            # a request is still being worked on, not the client's fault
+            self.set_deadline(self.phase, self.server.timeout)
+            return
+        if self.server.loop.time() >= self.deadline:
+            self.server.metrics.add_timeout(self.phase)
+            if self.phase == WRITE:
+                # close() would wait for the buffer to go to a client that
+                # isn't taking it. A sendfile in progress has to unwind
+                # first, asyncio can't lose the transport under it.
+                if self.sending:
+                    self.sending.cancel()
+                self.server.loop.call_soon(self.transport.abort)
+            else:
+                self.transport.close()
+            return
+        self.timer = self.server.loop.call_at(self.deadline, self.expire)
+
+    def data_received(self, data):
+        if self.closing:
+            return
+        self.buffer.feed(data)
+        self.process_requests()
+        self.reading()
+
+    def process_requests(self):
+        # handle each complete request in the buffer, in order
+        while not self.closing and not self.transport.is_closing() and self.waiting is None:
+            try:
+                req = self.buffer.next_request()
+            except RequestError as err:
+                self.server.reject(self.fd, err.status, time.time())
+                break
+            if req is None:
+                break
+            self.requests += 1
+            self.server.handle_request(req, self.fd)
+        self.buffer.release()
+        if self.parser:
+            self.parser.reset()
+
+    def pause_writing(self):
+        # the transport buffer is over the high-water mark; stop reading new
+        # requests until it drains, like the epoll engine does
+        self.writable.clear()
+        self.transport.pause_reading()
+        self.writing()
+
+    def resume_writing(self):
+        self.writable.set()
+        if not self.transport.is_closing() and self.waiting is None:
+            self.transport.resume_reading()
+        self.reading()
+
+    def write(self, parts, started, record):
+        if (self.sending is None and self.writable.is_set()
+                and not any(isinstance(part, (FileSegment, Producer)) for part in parts)):
+            # nothing ahead of it and no file or producer, write it right away
+            cork = self.server.tcp_cork and len(parts) > 1
+            if cork:
+                self.server.set_cork(self.sock, 1)
+            sent = 0
+            for part in parts:
+                self.transport.write(part)
+                sent += len(part)
+            if cork:
+                self.server.set_cork(self.sock, 0)
+            self.server.metrics.bytes_sent += sent
+            self.server.record_response(started, record, sent)
+            if self.closing:
+                self.transport.close()
+            return
+        self.responses.append((parts, started, record))
+        if self.sending is None:
+            self.sending = asyncio.ensure_future(self.send_responses())
+            self.writing()
+
+    async def send_responses(self):
+        """ Write queued responses in order. Plain buffers go to the
+        transport, file segments through the loop's sendfile, and producers
+        are asked for more only while the transport is below its limit. """
+        loop = self.server.loop
+        metrics = self.server.metrics
+        record = None
+        parts = ()
+        try:
+            while self.responses:
+                parts, started, record = self.responses.popleft()
+                # what is left of it, should it be cut short
+                parts = iter(parts)
+                sent = 0
+                for part in parts:
+                    if isinstance(part, FileSegment):
+                        await self.writable.wait()
+                        try:
+                            sent += await loop.sendfile(self.transport, part.file, part.offset, part.remaining)
+                        finally:
+                            part.close()
+                    elif isinstance(part, Producer):
+                        try:
+                            while True:
+                                await self.writable.wait()
+                                buffers = part.take()
+                                if buffers is False:
+                                    await self.made(part)
+                                    continue
+                                if buffers is None:
+                                    break
+                                for data in buffers:
+                                    self.transport.write(data)
+                                    sent += len(data)
+                                # a fast client never fills the transport, so
+                                # give other connections a turn
+                                await asyncio.sleep(0)
+                        finally:
+                            part.close()
+                    else:
+                        self.transport.write(part)
+                        sent += len(part)
+                    await self.writable.wait()
+                metrics.bytes_sent += sent
+                self.server.record_response(started, record, sent)
+                record = None
+            if self.closing:
+                self.transport.close()
+        except (ConnectionError, OSError):
+            self.transport.abort()
+        finally:
+            # a response that was cut short
+            self.server.close_parts(parts)
+            self.server.discard_record(record)
+            self.sending = None
+        self.reading()
+
+    async def made(self, producer):
+        """ Wait for a pool to make the producer's next buffer """
+        ready = self.server.loop.create_future()
+        producer.wakeup = lambda: ready.done() or ready.set_result(None)
+        self.stalled = True
+        try:
+            await ready
+        finally:
+            self.stalled = False
+
+class AsyncioServer(Poller):
+    """ Serves the same requests, caches and config as Poller, but on an
+    asyncio event loop with protocols and transports instead of epoll """
+    def __init__(self, args, reuseport=False):
+        Poller.__init__(self, args, reuseport)
+        # fd -> HttpProtocol
+        self.protocols = {}
+        # pause reading from a client above this much unsent response data
+        self.write_high_water = 1024 * 256
+        self.loop = None
+        self.rescan_timer = None
+        # how often buffered_bytes and loop_lag are sampled
+        self.load_interval = 0.1
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: HttpProtocol(self), sock=self.server))
+        if self.access_log:
+            self.access_log.start()
+        if self.disk_pool:
+            self.disk_pool.start()
+            self.loop.add_reader(self.disk_pool.fileno(), self.disk_pool.run_callbacks)
+        if self.wsgi_pool:
+            self.wsgi_pool.start()
+            self.loop.add_reader(self.wsgi_pool.fileno(), self.wsgi_pool.run_callbacks)
+        self.start_docindex()
+        self.loop.call_later(self.load_interval, self.sample_load, self.loop.time() + self.load_interval)
+        # runs on the loop, between callbacks
+        self.loop.add_signal_handler(signal.SIGHUP, self.reload)
+        self.loop.add_signal_handler(signal.SIGUSR1, self.profiler.toggle_profile)
+        self.loop.add_signal_handler(signal.SIGUSR2, self.profiler.toggle_tracing)
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            self.shutdown()
+
+    def sample_load(self, expected):
+        """ Loop lag is how late this callback runs; transports keep their
+        own buffers, so buffered bytes are added up here rather than on
+        every write """
+        now = self.loop.time()
+        self.loop_lag = max(0.0, now - expected)
+        if self.profiler.lag is not None:
+            self.profiler.add_lag(self.loop_lag)
+        self.buffered = sum(protocol.transport.get_write_buffer_size() for protocol in self.protocols.values())
+        self.loop.call_later(self.load_interval, self.sample_load, now + self.load_interval)
+
+    def send_response(self, fd, response, started, record=None):
+        protocol = self.protocols.get(fd)
+        if protocol is None:
+            self.close_parts(response)
+            self.discard_record(record)
+            return
+        protocol.write(response, started, record)
+
+    def watch_docindex(self, watching):
+        if watching:
+            self.loop.add_reader(self.docindex.fileno(), self.update_docindex)
+        else:
+            self.rescan_timer = self.loop.call_later(self.docindex.rescan_interval, self.rescan_docindex)
+
+    def stop_docindex(self):
+        if self.docindex.watching():
+            self.loop.remove_reader(self.docindex.fileno())
+        elif self.rescan_timer:
+            self.rescan_timer.cancel()
+        self.docindex.close()
+
+    def rescan_docindex(self):
+        self.update_docindex()
+        self.rescan_timer = self.loop.call_later(self.docindex.rescan_interval, self.rescan_docindex)
+
+    def client(self, fd):
+        return self.protocols.get(fd)
+
+    def park(self, protocol, req):
+        protocol.waiting = req
+        protocol.transport.pause_reading()
+
+    def resume_client(self, fd):
+        protocol = self.protocols.get(fd)
+        if protocol:
+            if protocol.writable.is_set() and not protocol.transport.is_closing():
+                protocol.transport.resume_reading()
+            protocol.process_requests()
+            protocol.reading()
+
+    def record_response(self, started, record, size):
+        # the response has been handed to the transport
+        elapsed = time.time() - started
+        self.metrics.response_time.add(elapsed)
+        if record:
+            record[5] = size
+            record[6] = elapsed
+            record[8].add(record)
+
+    def connection_gauges(self):
+        idle = 0
+        writing = 0
+        waiting = 0
+        for protocol in self.protocols.values():
+            if protocol.responses or protocol.sending:
+                writing += 1
+            elif protocol.buffer.empty():
+                idle += 1
+            if protocol.waiting is not None:
+                waiting += 1
+        return {"connections": len(self.protocols), "idle_connections": idle,
+            "writing_connections": writing, "disk_waiting": waiting}
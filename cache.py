@@ -0,0 +1,110 @@
+import os
+import time
+from collections import OrderedDict
+
+class CacheEntry:
+    """ Response data for one file in the document root """
+    def __init__(self, path, body, mime_type, last_modified, length, mtime, inode, encoding=None):
+        self.path = path
+        # None when the file is too big to keep, then only metadata is cached
+        self.body = body
+        self.mime_type = mime_type
+        self.last_modified = last_modified
+        self.length = length
+        self.mtime = mtime
+        self.inode = inode
+        # Content-Encoding of the body, "gzip" for a compressed variant
+        self.encoding = encoding
+        # strong validator, changes whenever the file is replaced or written
+        self.etag = '"%x-%x-%x"' % (inode, length, int(mtime * 1000000))
+        # False once we know there is no worthwhile gzip variant
+        self.gzip = None
+        # response headers, encoded the first time the entry is sent
+        self.headers = None
+        self.validators = None
+        # when the file was last checked with stat
+        self.checked = time.time()
+
+    def cost(self):
+        # count a rough per-entry overhead so metadata-only entries are bounded too
+        return 256 + (len(self.body) if self.body is not None else 0)
+
+class Cache:
+    """ Size-bounded LRU cache of static file responses, keyed by path """
+    def __init__(self, max_bytes, revalidate):
+        self.max_bytes = max_bytes
+        # seconds between stat checks of a cached file, None to never check
+        self.revalidate = revalidate
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path):
+        entry = self.entries.get(path)
+        if entry is None:
+            self.misses += 1
+            return None
+        now = time.time()
+        if self.revalidate is not None and now - entry.checked >= self.revalidate:
+            if not self.is_fresh(path, entry):
+                self.remove(path)
+                self.misses += 1
+                return None
+            entry.checked = now
+        # move to the most recently used end
+        del self.entries[path]
+        self.entries[path] = entry
+        self.hits += 1
+        return entry
+
+    def peek(self, path):
+        """ Returns the entry if it can be used without a stat, without
+        counting a hit or miss or changing the LRU order """
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+        if self.revalidate is not None and time.time() - entry.checked >= self.revalidate:
+            return None
+        return entry
+
+    def is_fresh(self, path, entry):
+        try:
+            info = os.stat(path)
+        except OSError:
+            return False
+        return (info.st_mtime == entry.mtime and info.st_size == entry.length
+            and info.st_ino == entry.inode)
+
+    def put(self, path, entry):
+        if entry.cost() > self.max_bytes:
+            return
+        self.remove(path)
+        self.entries[path] = entry
+        self.size += entry.cost()
+        self.evict()
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def evict(self):
+        # evict least recently used entries until we are under budget
+        while self.size > self.max_bytes:
+            old_path, old_entry = self.entries.popitem(last=False)
+            self.size -= old_entry.cost()
+            self.evictions += 1
+
+    def remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= entry.cost()
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.size,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
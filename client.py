@@ -1,6 +1,12 @@
+from __future__ import print_function
+
 import socket
 import sys
 
+# the raw byte streams on python 3
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
 class Client:
     """ Echo client """
     def __init__(self,host,port):
@@ -8,30 +14,33 @@ class Client:
         self.port = port
         self.size = 1024
         self.open_socket()
-        print "Enter a blank line to stop."
-        sys.stdout.write('> ')
+        print("Enter a blank line to stop.")
+        sys.stdout.flush()
+        stdout.write(b'> ')
+        stdout.flush()
 
     def open_socket(self):
         """ Connect to the server """
         try:
             self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server.connect((self.host,self.port))
-        except socket.error, (value,message):
+        except socket.error as err:
             if self.server:
                 self.server.close()
-            print "Could not open socket: " + message
+            print("Could not open socket: %s" % err)
             sys.exit(1)
 
     def run(self):
         """ Read from the keyboard and send this line to the server """
         while True:
             # read from keyboard
-            line = sys.stdin.readline()
-            if line == '\n':
+            line = stdin.readline()
+            if line == b'\n':
                 break
             self.server.send(line)
             data = self.server.recv(self.size)
-            sys.stdout.write(data)
-            sys.stdout.write('> ')
+            stdout.write(data)
+            stdout.write(b'> ')
+            stdout.flush()
         self.server.close()
 
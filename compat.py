@@ -0,0 +1,15 @@
+if bytes is str:
+    # python 2, bytes are already str
+    def to_str(data):
+        return bytes(data)
+
+    def to_bytes(text):
+        return text if isinstance(text, bytes) else text.encode("utf-8")
+else:
+    # latin-1 maps every byte to one character and back, so nothing on
+    # the wire is lost in between
+    def to_str(data):
+        return bytes(data).decode("latin-1")
+
+    def to_bytes(text):
+        return text.encode("latin-1")
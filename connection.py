@@ -0,0 +1,42 @@
+# what the connection is registered with epoll for
+READING = 0
+WRITING = 1
+CLOSED = 2
+
+# what a client's deadline is for, also the labels of the expiry counters
+FIRST_BYTE = "first_byte"
+HEADER = "header"
+BODY = "body"
+KEEPALIVE = "keepalive"
+WRITE = "write"
+
+class Connection(object):
+    """ Everything the epoll loop keeps for one client. Slots keep an idle
+    connection down to the object itself and its socket; the request
+    buffer and output queue only hold memory while they are in use. """
+    __slots__ = ("sock", "fd", "ip", "buffer", "parser", "outbound", "state", "closing", "waiting",
+        "deadline", "phase", "phase_requests", "requests", "received")
+
+    def __init__(self, sock, ip, buffer):
+        self.sock = sock
+        # kept, since fileno() is -1 once the socket is closed
+        self.fd = sock.fileno()
+        # the client's address, which connection caps and rate limits go by
+        self.ip = ip
+        self.buffer = buffer
+        # RequestParser, reused for every request on the connection
+        self.parser = None
+        # OutQueue, created when there is something to send
+        self.outbound = None
+        self.state = READING
+        # send what is queued, then close
+        self.closing = False
+        # request parked on the disk or WSGI pool, later requests wait behind it
+        self.waiting = None
+        self.deadline = 0
+        # FIRST_BYTE, HEADER, BODY, KEEPALIVE or WRITE
+        self.phase = None
+        # requests served when the phase began
+        self.phase_requests = 0
+        self.requests = 0
+        self.received = 0
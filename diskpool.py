@@ -0,0 +1,71 @@
+import errno
+import fcntl
+import os
+import threading
+from collections import deque
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+class DiskPool:
+    """ Threads for blocking filesystem work, and for WSGI applications.
+    Results come back to the event loop through a pipe that the loop polls
+    like any other socket; callbacks always run on the loop thread. """
+    def __init__(self, threads, name="disk"):
+        self.size = threads
+        self.name = name
+        self.jobs = Queue()
+        self.results = deque()
+        self.threads = []
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        for fd in (self.wakeup_read, self.wakeup_write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def start(self):
+        # started from the loop, so each forked worker gets its own threads
+        for i in range(self.size):
+            thread = threading.Thread(target=self.work, name="%s-%i" % (self.name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def fileno(self):
+        return self.wakeup_read
+
+    def pending(self):
+        return self.jobs.qsize()
+
+    def submit(self, func, args, callback):
+        """ Run func(*args) on the pool, then callback(result, error) on
+        the loop """
+        self.jobs.put((func, args, callback))
+
+    def work(self):
+        while True:
+            func, args, callback = self.jobs.get()
+            try:
+                result, error = func(*args), None
+            except Exception as err:
+                result, error = None, err
+            self.results.append((callback, result, error))
+            try:
+                os.write(self.wakeup_write, b"x")
+            except OSError as err:
+                # a full pipe means the loop has a wakeup pending anyway
+                if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def run_callbacks(self):
+        """ Called by the loop when the wakeup pipe is readable """
+        try:
+            while os.read(self.wakeup_read, 4096):
+                pass
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        while self.results:
+            callback, result, error = self.results.popleft()
+            callback(result, error)
@@ -0,0 +1,278 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import stat
+import struct
+import time
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+EVENT_HEADER = struct.Struct("iIII")
+
+def load_inotify():
+    """ Returns libc if it has inotify, else None """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+class IndexEntry:
+    """ What a lookup needs to know about one file in the document root """
+    def __init__(self, filename, mime_type, info):
+        self.filename = filename
+        self.mime_type = mime_type
+        self.length = info.st_size
+        self.mtime = info.st_mtime
+        self.inode = info.st_ino
+
+class DocIndex:
+    """ Index of the document root, mapping normalized URL paths to file
+    metadata so a lookup is one dict hit rather than string work and a
+    stat. Kept current with inotify where the platform has it, otherwise
+    by rescanning every few seconds; between rescans, paths missing from
+    the index are probed once and remembered as 404s. """
+    default_type = "application/octet-stream"
+
+    def __init__(self, root, mime_types, rescan=5.0, watch=True, max_negative=10000):
+        self.root = root
+        self.mime_types = mime_types
+        self.rescan_interval = rescan
+        self.use_inotify = watch
+        self.max_negative = max_negative
+        # URL path -> IndexEntry
+        self.files = {}
+        # URL paths known not to exist
+        self.negative = set()
+        self.inotify = None
+        # watch descriptor -> URL path of the directory
+        self.watches = {}
+        self.next_rescan = None
+        self.rescans = 0
+        self.scan()
+
+    def start(self):
+        """ Start watching the tree. Called from the loop, so each forked
+        worker gets its own inotify descriptor. Returns True if changes will
+        be reported through fileno(), False if the index is rescanned. """
+        libc = load_inotify() if self.use_inotify else None
+        if libc:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.inotify = (libc, fd)
+                # watches go on before the rescan, so nothing is missed in between
+                self.scan()
+                return True
+            logging.warning("inotify unavailable (%s), rescanning %s every %ss" %
+                (os.strerror(ctypes.get_errno()), self.root, self.rescan_interval))
+        self.next_rescan = time.time() + self.rescan_interval
+        return False
+
+    def fileno(self):
+        return self.inotify[1] if self.inotify else None
+
+    def close(self):
+        if self.inotify:
+            os.close(self.inotify[1])
+            self.inotify = None
+
+    def watching(self):
+        return self.inotify is not None
+
+    def lookup(self, path):
+        """ Returns the IndexEntry for a URL path, or None if there is no
+        such file. Raises ValueError for a path that tries to leave the
+        document root. """
+        entry = self.files.get(path)
+        if entry is not None:
+            return entry
+        if path in self.negative:
+            return None
+        parts = path.split("/")
+        if ".." in parts or "\0" in path:
+            raise ValueError(path)
+        # not normalized, e.g. "//" or "/./"
+        normalized = "/" + "/".join(part for part in parts if part and part != ".")
+        if path.endswith("/") and normalized != "/":
+            normalized += "/"
+        entry = self.files.get(normalized)
+        if entry is not None or self.inotify:
+            # with inotify the index is complete
+            return entry
+        # created since the last rescan?
+        entry = self.stat_file(normalized)
+        if entry is None:
+            self.remember_missing(path)
+        else:
+            self.add(normalized, entry)
+        return entry
+
+    def remember_missing(self, path):
+        if len(self.negative) >= self.max_negative:
+            self.negative.clear()
+        self.negative.add(path)
+
+    def filename(self, path):
+        return self.root + path
+
+    def stat_file(self, path):
+        filename = self.filename(path)
+        try:
+            info = os.stat(filename)
+        except OSError:
+            return None
+        if not stat.S_ISREG(info.st_mode):
+            return None
+        ext = os.path.splitext(path)[1]
+        return IndexEntry(filename, self.mime_types.get(ext[1:], self.default_type), info)
+
+    def add(self, path, entry):
+        self.files[path] = entry
+        if path == "/index.html":
+            self.files["/"] = entry
+
+    def remove(self, path):
+        entry = self.files.pop(path, None)
+        if path == "/index.html":
+            self.files.pop("/", None)
+        return entry
+
+    def scan(self, top="/"):
+        """ Walk the tree under a URL path, replacing what the index holds
+        for it. Returns the filenames that were added, changed or removed. """
+        return self.update(self.walk(top), top)
+
+    def walk(self, top="/"):
+        """ Stat every file under a URL path, returning URL path ->
+        IndexEntry. Without inotify this leaves the index alone, so it can
+        run on a pool thread. """
+        found = {}
+        for dirpath, dirnames, filenames in os.walk(self.filename(top)):
+            prefix = dirpath[len(self.root):].replace(os.sep, "/")
+            if not prefix.endswith("/"):
+                prefix += "/"
+            self.watch(prefix)
+            for name in filenames:
+                entry = self.stat_file(prefix + name)
+                if entry is not None:
+                    found[prefix + name] = entry
+        return found
+
+    def update(self, found, top="/"):
+        """ Replace what the index holds under a URL path with what walk()
+        found there """
+        old = dict((path, entry) for (path, entry) in self.files.items()
+            if path.startswith(top) and path != "/")
+        if top == "/":
+            old.pop("/", None)
+        changed = []
+        for path, entry in old.items():
+            if path not in found:
+                self.remove(path)
+                changed.append(entry.filename)
+        for path, entry in found.items():
+            previous = old.get(path)
+            if previous is None or (previous.mtime, previous.length, previous.inode) != (entry.mtime, entry.length, entry.inode):
+                changed.append(entry.filename)
+            self.add(path, entry)
+        self.negative.clear()
+        return changed
+
+    def rescan(self, found=None):
+        """ Periodic refresh when there is no inotify; found is what walk()
+        returned, when the tree was walked on a pool """
+        self.next_rescan = time.time() + self.rescan_interval
+        self.rescans += 1
+        if found is None:
+            return self.scan()
+        return self.update(found)
+
+    def watch(self, prefix):
+        if not self.inotify:
+            return
+        libc, fd = self.inotify
+        filename = self.filename(prefix)
+        if not isinstance(filename, bytes):
+            filename = filename.encode("utf-8")
+        wd = libc.inotify_add_watch(fd, filename, WATCH_MASK)
+        if wd < 0:
+            logging.warning("Could not watch %s: %s" % (prefix, os.strerror(ctypes.get_errno())))
+            return
+        self.watches[wd] = prefix
+
+    def read_events(self):
+        """ Apply pending inotify events. Returns the filenames that were
+        added, changed or removed. """
+        changed = []
+        fd = self.inotify[1]
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0").decode("utf-8", "replace")
+                offset += length
+                changed.extend(self.apply_event(wd, mask, name))
+        if changed:
+            self.negative.clear()
+        return changed
+
+    def apply_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # events were lost, start over
+            logging.warning("inotify queue overflowed, rescanning %s" % self.root)
+            return self.scan()
+        prefix = self.watches.get(wd)
+        if prefix is None:
+            return []
+        if mask & (IN_IGNORED | IN_DELETE_SELF):
+            del self.watches[wd]
+            return []
+        path = prefix + name
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                return self.scan(path + "/")
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                return [entry.filename for entry in
+                    [self.remove(key) for key in list(self.files) if key.startswith(path + "/")]
+                    if entry is not None]
+            return []
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            entry = self.remove(path)
+            return [entry.filename] if entry else []
+        entry = self.stat_file(path)
+        if entry is None:
+            entry = self.remove(path)
+            return [entry.filename] if entry else []
+        self.add(path, entry)
+        return [entry.filename]
+
+    def stats(self):
+        return {"files": len(self.files), "negative": len(self.negative),
+            "watches": len(self.watches), "rescans": self.rescans}
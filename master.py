@@ -0,0 +1,95 @@
+import errno
+import logging
+import os
+import signal
+import socket
+import time
+
+from poller import Poller
+
+class Master:
+    """ Pre-forks worker processes that each run their own Poller.
+
+    Each worker binds its own SO_REUSEPORT listener so the kernel spreads
+    connections between them. Where SO_REUSEPORT is not available, the
+    listener is opened once here and inherited by every worker instead.
+    Workers that die are restarted; SIGTERM/SIGINT stop every worker;
+    SIGHUP is forwarded to them, and each reloads web.conf in place, and so
+    are SIGUSR1/SIGUSR2, which toggle each worker's profiler. """
+    def __init__(self, args, engine=Poller):
+        self.args = args
+        # Poller, or another engine class with the same constructor
+        self.engine = engine
+        self.reuseport = hasattr(socket, "SO_REUSEPORT")
+        self.running = True
+        # worker pid -> time it was started
+        self.workers = {}
+        self.poller = None
+
+    def run(self):
+        if not self.reuseport:
+            logging.warning("SO_REUSEPORT not available, sharing one listener between workers")
+            self.poller = self.engine(self.args)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_forward)
+        signal.signal(signal.SIGUSR1, self.handle_forward)
+        signal.signal(signal.SIGUSR2, self.handle_forward)
+        for i in range(self.args.workers):
+            self.spawn()
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except OSError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            started = self.workers.pop(pid, None)
+            if started is None or not self.running:
+                continue
+            if os.WIFSIGNALED(status):
+                logging.warning("worker %i killed by signal %i, restarting" % (pid, os.WTERMSIG(status)))
+            else:
+                logging.warning("worker %i exited with status %i, restarting" % (pid, os.WEXITSTATUS(status)))
+            if time.time() - started < 1:
+                # don't spin if workers die right after starting
+                time.sleep(1)
+            self.spawn()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return
+        # worker process
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            # the engine handles these once it is running
+            for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2):
+                signal.signal(signum, signal.SIG_IGN)
+            poller = self.poller or self.engine(self.args, reuseport=True)
+            poller.run()
+        except KeyboardInterrupt:
+            pass
+        except SystemExit as err:
+            status = err.code if isinstance(err.code, int) else 1
+        except:
+            logging.exception("worker %i failed" % os.getpid())
+            status = 1
+        os._exit(status)
+
+    def handle_stop(self, signum, frame):
+        self.running = False
+        self.signal_workers(signal.SIGTERM)
+
+    def handle_forward(self, signum, frame):
+        self.signal_workers(signum)
+
+    def signal_workers(self, signum):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
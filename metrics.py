@@ -0,0 +1,115 @@
+import bisect
+import json
+import time
+
+# histogram bucket upper bounds in seconds, 1us to about 36 minutes
+BOUNDS = [(2 ** index) / 1000000.0 for index in range(32)]
+
+class Histogram:
+    """ Durations counted in log2 buckets; bucket i holds values up to and
+    including 2**i microseconds, the last one anything longer. Adding a
+    value is a binary search over the bounds. """
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def add(self, seconds):
+        # inclusive, as Prometheus defines le
+        self.counts[bisect.bisect_left(BOUNDS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def buckets(self):
+        """ Cumulative (upper bound in seconds, count) pairs """
+        result = []
+        total = 0
+        for bound, count in zip(BOUNDS, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class Metrics:
+    """ Counters and histograms for the Poller loop, rendered as Prometheus
+    text or JSON by the stats endpoint """
+    def __init__(self):
+        self.started = time.time()
+        self.requests = {}
+        self.bytes_sent = 0
+        self.accepts = 0
+        # reason -> connections or requests turned away under load
+        self.shed = {}
+        # deadline phase -> connections closed when it expired
+        self.timeouts = {}
+        self.parse_time = Histogram()
+        self.lookup_time = Histogram()
+        self.response_time = Histogram()
+        # accepts seen at the previous scrape, for the accept rate
+        self.last_scrape = (self.started, 0)
+
+    def add_request(self, status):
+        self.requests[status] = self.requests.get(status, 0) + 1
+
+    def add_shed(self, reason):
+        self.shed[reason] = self.shed.get(reason, 0) + 1
+
+    def add_timeout(self, phase):
+        self.timeouts[phase] = self.timeouts.get(phase, 0) + 1
+
+    def accept_rate(self):
+        """ Accepts per second since the previous scrape """
+        now = time.time()
+        then, accepts = self.last_scrape
+        self.last_scrape = (now, self.accepts)
+        return (self.accepts - accepts) / max(now - then, 0.001)
+
+    def snapshot(self, gauges, caches):
+        histograms = {}
+        for name, histogram in self.histograms():
+            histograms[name] = {"count": histogram.count, "sum": histogram.sum,
+                "buckets": [[bound, count] for bound, count in histogram.buckets() if count]}
+        return {"uptime": time.time() - self.started, "requests": self.requests,
+            "bytes_sent": self.bytes_sent, "accepts": self.accepts, "shed": self.shed,
+            "timeouts": self.timeouts, "accept_rate": self.accept_rate(), "gauges": gauges, "caches": caches,
+            "histograms": histograms}
+
+    def histograms(self):
+        return [("parse_seconds", self.parse_time), ("lookup_seconds", self.lookup_time),
+            ("response_seconds", self.response_time)]
+
+    def json(self, gauges, caches):
+        return json.dumps(self.snapshot(gauges, caches), sort_keys=True)
+
+    def prometheus(self, gauges, caches):
+        lines = ["# TYPE webserver_requests_total counter"]
+        for status in sorted(self.requests):
+            lines.append('webserver_requests_total{status="%s"} %i' % (status, self.requests[status]))
+        lines.append("# TYPE webserver_bytes_sent_total counter")
+        lines.append("webserver_bytes_sent_total %i" % self.bytes_sent)
+        lines.append("# TYPE webserver_accepts_total counter")
+        lines.append("webserver_accepts_total %i" % self.accepts)
+        lines.append("# TYPE webserver_shed_total counter")
+        for reason in sorted(self.shed):
+            lines.append('webserver_shed_total{reason="%s"} %i' % (reason, self.shed[reason]))
+        lines.append("# TYPE webserver_timeouts_total counter")
+        for phase in sorted(self.timeouts):
+            lines.append('webserver_timeouts_total{phase="%s"} %i' % (phase, self.timeouts[phase]))
+        lines.append("# TYPE webserver_accept_rate gauge")
+        lines.append("webserver_accept_rate %f" % self.accept_rate())
+        for name in sorted(gauges):
+            lines.append("# TYPE webserver_%s gauge" % name)
+            lines.append("webserver_%s %s" % (name, gauges[name]))
+        for key, kind in [("hits", "counter"), ("misses", "counter"), ("evictions", "counter"),
+                ("entries", "gauge"), ("bytes", "gauge")]:
+            metric = "webserver_cache_%s%s" % (key, "_total" if kind == "counter" else "")
+            lines.append("# TYPE %s %s" % (metric, kind))
+            for name in sorted(caches):
+                lines.append('%s{cache="%s"} %i' % (metric, name, caches[name][key]))
+        for name, histogram in self.histograms():
+            lines.append("# TYPE webserver_%s histogram" % name)
+            for bound, count in histogram.buckets():
+                lines.append('webserver_%s_bucket{le="%g"} %i' % (name, bound, count))
+            lines.append('webserver_%s_bucket{le="+Inf"} %i' % (name, histogram.count))
+            lines.append("webserver_%s_sum %f" % (name, histogram.sum))
+            lines.append("webserver_%s_count %i" % (name, histogram.count))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,265 @@
+import errno
+import logging
+import socket
+from collections import deque
+
+from compat import to_bytes
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # python 2 needs the pysendfile package
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+class FileSegment:
+    """ A range of an open file that is sent straight from its descriptor """
+    def __init__(self, content_file, offset, count, owner=True):
+        self.file = content_file
+        self.offset = offset
+        self.remaining = count
+        # several segments can share a file, only its owner closes it
+        self.owner = owner
+        self.chunk = 1024 * 64
+
+    def __len__(self):
+        return self.remaining
+
+    def send(self, sock):
+        """ Send the next part of the segment. Returns the number of bytes
+        sent; raises socket.error/OSError like a socket send. """
+        if sendfile:
+            count = sendfile(sock.fileno(), self.file.fileno(), self.offset, self.remaining)
+        else:
+            # no sendfile available, copy through a bounded buffer instead
+            self.file.seek(self.offset)
+            data = self.file.read(min(self.remaining, self.chunk))
+            count = sock.send(data) if data else 0
+        if count == 0:
+            # the file was truncated after we sent its length
+            raise OSError(errno.EIO, "file shorter than expected")
+        self.offset += count
+        self.remaining -= count
+        return count
+
+    def close(self):
+        if self.owner:
+            self.file.close()
+
+# buffers taken from a producer in one flush, so a fast client can't keep
+# the loop on one long body
+PRODUCER_BURST = 16
+
+class Producer:
+    """ A response body made while it is sent, from an iterable of buffers
+    such as a generator. The next buffer is only asked for once everything
+    before it has been sent, so a connection holds one buffer at a time
+    however long the body is. A body of unknown length goes out with
+    chunked transfer encoding. With a pool, each buffer is made on one of
+    its threads, for iterables that block or do heavy work. """
+    def __init__(self, iterable, chunked=False, pool=None):
+        self.iterable = iterable
+        self.iterator = iter(iterable)
+        self.chunked = chunked
+        self.done = False
+        self.pool = pool
+        # (buffers, error) back from the pool and not yet taken
+        self.made = None
+        self.making = False
+        # called on the loop once buffers made on the pool are ready
+        self.wakeup = None
+        self.closed = False
+
+    def next(self):
+        """ Returns the next buffers to send, or None once the body is
+        complete. An error in the iterable raises OSError, since the head
+        has gone out and all that can be done is drop the connection. """
+        if self.done:
+            return None
+        while True:
+            try:
+                data = next(self.iterator)
+            except StopIteration:
+                self.done = True
+                # the last chunk has no data
+                return [b"0\r\n\r\n"] if self.chunked else None
+            except Exception:
+                logging.exception("response producer failed")
+                raise OSError(errno.EIO, "response producer failed")
+            if not isinstance(data, (bytes, bytearray, memoryview)):
+                logging.error("response producer returned %s, not bytes" % type(data).__name__)
+                raise OSError(errno.EIO, "response producer failed")
+            # an empty chunk would end the body, so empty buffers are skipped
+            if data:
+                break
+        if self.chunked:
+            return [to_bytes("%x\r\n" % len(data)), data, b"\r\n"]
+        return [data]
+
+    def take(self):
+        """ The next buffers, as next() returns them. With a pool they are
+        made there: this returns False until they are ready, and calls
+        wakeup() on the loop when they are. """
+        if self.pool is None:
+            return self.next()
+        if self.made is not None:
+            buffers, error = self.made
+            self.made = None
+            if error is not None:
+                raise error
+            return buffers
+        if self.done:
+            return None
+        if not self.making:
+            self.making = True
+            self.pool.submit(self.next, (), self.finished_making)
+        return False
+
+    def finished_making(self, buffers, error):
+        self.making = False
+        if self.closed:
+            # dropped while the pool was busy with it
+            self.release()
+            return
+        self.made = (buffers, error)
+        if self.wakeup:
+            self.wakeup()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if not self.making:
+            # otherwise the iterable is in use on the pool, and is
+            # released once it comes back
+            self.release()
+
+    def release(self):
+        # generators and WSGI iterables release what they hold in close()
+        close = getattr(self.iterable, "close", None)
+        if close:
+            close()
+
+class OutQueue:
+    """ Outbound buffer queue for a single client connection """
+    def __init__(self):
+        # buffers, file segments and producers to send, with a
+        # (start time, log record) tuple marking where each response ends
+        self.buffers = deque()
+        # bytes of the first buffer that have already been sent
+        self.offset = 0
+        # bytes sent of the response at the front of the queue
+        self.response_sent = 0
+        # bytes held in memory until they are sent; file segments are
+        # left out, they are read from disk as they go
+        self.pending = 0
+        # (start time, log record, bytes) for responses that have been
+        # fully sent but not yet collected by finished()
+        self.done = []
+
+    def push(self, data):
+        if data:
+            self.buffers.append(data)
+            if not isinstance(data, (FileSegment, Producer)):
+                self.pending += len(data)
+        elif isinstance(data, FileSegment):
+            data.close()
+
+    def empty(self):
+        return not self.buffers
+
+    def stalled(self):
+        """ True while nothing can be sent until a pool makes the next buffer """
+        return bool(self.buffers) and isinstance(self.buffers[0], Producer) and self.buffers[0].making
+
+    def idle(self):
+        # nothing to send and no response waiting to be recorded
+        return not self.buffers and not self.done
+
+    def flush(self, sock):
+        """ Send as much queued data as the socket will take without
+        blocking. Returns the number of bytes sent. """
+        sent = 0
+        pulled = 0
+        buffers = self.buffers
+        while buffers:
+            data = buffers[0]
+            if type(data) is tuple:
+                # the end of a response
+                buffers.popleft()
+                self.done.append(data + (self.response_sent,))
+                self.response_sent = 0
+                continue
+            if isinstance(data, Producer):
+                if pulled == PRODUCER_BURST:
+                    break
+                pulled += 1
+                more = data.take()
+                if more is False:
+                    # being made on a pool, its wakeup resumes sending
+                    break
+                if more is None:
+                    buffers.popleft()
+                    data.close()
+                else:
+                    buffers.extendleft(reversed(more))
+                    self.pending += sum(len(part) for part in more)
+                continue
+            try:
+                if isinstance(data, FileSegment):
+                    count = data.send(sock)
+                else:
+                    count = sock.send(memoryview(data)[self.offset:])
+            except (socket.error, OSError) as err:
+                # socket buffer is full, wait for the next EPOLLOUT
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            sent += count
+            self.response_sent += count
+            if isinstance(data, FileSegment):
+                if data.remaining:
+                    break
+                data.close()
+                buffers.popleft()
+                continue
+            self.pending -= count
+            self.offset += count
+            if self.offset < len(data):
+                # partial write, the socket buffer is full
+                break
+            buffers.popleft()
+            self.offset = 0
+        return sent
+
+    def mark(self, started, record=None):
+        """ Mark the end of a response that was started at the given time """
+        if self.buffers:
+            self.buffers.append((started, record))
+        else:
+            # already sent
+            self.done.append((started, record, self.response_sent))
+            self.response_sent = 0
+
+    def finished(self):
+        """ Returns (start time, log record, bytes sent) for responses that
+        are now fully sent """
+        done = self.done
+        self.done = []
+        return done
+
+    def close(self):
+        """ Release any files and producers still waiting to be sent.
+        Returns the log records of responses that won't be finished. """
+        records = [done[1] for done in self.done]
+        for data in self.buffers:
+            if isinstance(data, (FileSegment, Producer)):
+                data.close()
+            elif type(data) is tuple:
+                records.append(data[1])
+        self.buffers.clear()
+        self.done = []
+        self.pending = 0
+        return records
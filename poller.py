@@ -1,47 +1,150 @@
 import errno
+import fcntl
+import io
 import select
 import socket
 import sys
 import traceback
+import zlib
 import argparse
 import logging
 import os
-from urlparse import urlparse
+import random
+import signal
+import tempfile
+import time
+try:
+    from urlparse import urlparse
+except ImportError:
+    # python 3
+    from urllib.parse import urlparse
 from wsgiref.handlers import format_date_time
 from datetime import datetime
+from email.utils import parsedate_tz, mktime_tz
 from time import mktime
 
+from accesslog import AccessLog
+from cache import Cache, CacheEntry
+from compat import to_bytes
+from connection import Connection, READING, WRITING, CLOSED, FIRST_BYTE, HEADER, KEEPALIVE, WRITE
+from diskpool import DiskPool
+from docindex import DocIndex
+from metrics import Metrics
+from ratelimit import RateLimiter
+from outqueue import OutQueue, FileSegment, Producer
+from profiler import Profiler
+from reqbuffer import RequestBuffer, RequestError
+from reqparser import RequestParser
+from timers import Timers
+from wsgiapp import WsgiApp, HOP_HEADERS
+
 try:
     from http_parser.parser import HttpParser
+    http_parser_extension = True
 except ImportError:
-    from http_parser.pyparser import HttpParser
+    http_parser_extension = False
+    try:
+        from http_parser.pyparser import HttpParser
+    except ImportError:
+        # only needed with --parser http-parser
+        HttpParser = None
+
+SERVER = "python small server 1.0"
+
+# status line -> its encoded form, filled in as statuses are used
+STATUS_LINES = {}
+
+class ConfigError(Exception):
+    """ web.conf can't be used; the message says why """
 
 class Poller:
     """ Polling server """
-    def __init__(self,args):
+    def __init__(self,args,reuseport=False):
         logging.debug("Poller.__init__()...")
         logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARN)
         
         # parse web.conf
-        configs = self.parse_conf_file()
+        try:
+            self.settings = self.read_config()
+        except ConfigError as err:
+            logging.error("%s\nExiting..." % err)
+            sys.exit(1)
+        settings = self.settings
 
         # set server cnnfiguration from web.conf
-        self.host = self.get_host(configs)
-        self.root = self.get_root(configs)
         self.port = args.port
+        # set when several worker processes each bind their own listener
+        self.reuseport = reuseport
+        self.apply_settings(settings)
+        # "builtin" for RequestParser, "http-parser" for HttpParser
+        self.parser = args.parser
+        if self.parser == "http-parser":
+            if HttpParser is None:
+                logging.error("http-parser is not installed\nExiting...")
+                sys.exit(1)
+            if not http_parser_extension:
+                logging.warning("http-parser's C extension is not installed, using its much slower pure Python parser")
         self.open_socket()
-        self.supportedMIMEtypes = self.get_supportedMIMEtypes(configs)
-        self.timeout = self.get_timeout(configs)
-        self.clients = {}
-        self.clientIdleTime = {}
-        self.cache = {}
+        # the first scan is done here, so without SO_REUSEPORT workers share
+        # it; with it, each worker builds its own index
+        self.docindex = self.new_docindex(settings)
+        self.filecache = Cache(settings["cache_bytes"], settings["cache_revalidate"])
+        # gzip variants, keyed by the versions of the file and of any .gz
+        # sibling, so they never need a stat
+        self.gzcache = Cache(settings["gzip_cache_bytes"], None)
+        # fd -> Connection
+        self.connections = {}
+        # clients open, in total and per address, for the connection caps
+        self.open_clients = 0
+        # when to poll the listener again after running out of descriptors
+        # or memory, None while accepting
+        self.accept_paused = None
+        # whether that has been logged since the last successful accept
+        self.accept_warned = False
+        self.ip_connections = {}
+        # what the admission check looks at: bytes queued in memory for
+        # clients, and how long events last waited for the loop
+        self.buffered = 0
+        self.loop_lag = 0.0
+        # the current deadline for each client, see read_deadline
+        self.timers = Timers()
         self.size = 1024 * 10
+        # more ranges than this in one request are ignored
+        self.max_ranges = 16
+        self.metrics = Metrics()
+        self.disk_pool = None
+        if settings["disk_threads"]:
+            self.disk_pool = DiskPool(settings["disk_threads"])
+        # WSGI applications, tried longest prefix first
+        try:
+            self.wsgi_apps = self.new_wsgi_apps(settings)
+        except ConfigError as err:
+            logging.error("%s\nExiting..." % err)
+            sys.exit(1)
+        self.wsgi_pool = None
+        if self.wsgi_apps:
+            self.wsgi_pool = DiskPool(settings["wsgi_threads"], "wsgi")
+        self.multiprocess = getattr(args, "workers", 1) > 1
+        self.access_log = self.new_access_log(settings)
+        self.boundary = "%016x" % random.getrandbits(64)
+        # Date and Server headers, reused within the same second
+        self.date_second = None
+        self.date_block = None
+        # set by SIGHUP, web.conf is re-read between loop iterations
+        self.reload_pending = False
+        self.reloads = 0
+        # SIGUSR1 and SIGUSR2 toggle profiling, also between iterations
+        self.profiler = Profiler(self)
+        self.profiler_pending = []
 
-        logging.debug("CONFIGS: %s" % configs)
+        logging.debug("CONFIGS: %s" % settings)
         logging.debug("Host: %s" % self.host)
         logging.debug("Root: %s" % self.root)
         logging.debug("Supported MIME types: %s" % self.supportedMIMEtypes)
-        logging.debug("timeout: %s" % self.timeout)
+        logging.debug("timeouts: first byte %ss, header %ss, body %ss, keep-alive %ss, write %ss" %
+            (self.first_byte_timeout, self.header_timeout, self.body_timeout, self.timeout, self.write_timeout))
+        logging.debug("cache: %i bytes, revalidate every %ss, files up to %i bytes" %
+            (self.filecache.max_bytes, self.filecache.revalidate, self.cache_max_file))
 
         ##############################################
 
@@ -50,31 +153,81 @@ class Poller:
         try:
             self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,1)
+            if self.reuseport:
+                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT,1)
+            # accepted sockets inherit the buffer sizes, which have to be set
+            # before the handshake for the window scale to match
+            if self.rcvbuf:
+                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+            if self.sndbuf:
+                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+            if self.tcp_defer_accept and hasattr(socket, "TCP_DEFER_ACCEPT"):
+                # don't wake up for a connection until its request arrives
+                self.server.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, self.tcp_defer_accept)
             self.server.bind((self.host,self.port))
-            self.server.listen(5)
+            self.server.listen(self.listen_backlog)
             self.server.setblocking(0)
-        except socket.error, (value,message):
+        except socket.error as err:
             if self.server:
                 self.server.close()
-            logging.error("Could not open socket: " + message + "\nExiting. Gracefully.\n=)")
+            logging.error("Could not open socket: " + str(err) + "\nExiting. Gracefully.\n=)")
             sys.exit(1)
 
     def run(self):
         """ Use poll() to handle each incoming client."""
         self.poller = select.epoll()
         self.pollmask = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+        # used while a client has queued output; reading is paused until
+        # the queue drains so a slow reader can't grow it without bound
+        self.writemask = select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR
+        # used while the next buffer to send is being made on a pool
+        self.waitmask = select.EPOLLHUP | select.EPOLLERR
         self.poller.register(self.server,self.pollmask)
+        if self.access_log:
+            self.access_log.start()
+        if self.disk_pool:
+            self.disk_pool.start()
+            self.poller.register(self.disk_pool.fileno(),select.EPOLLIN)
+        if self.wsgi_pool:
+            self.wsgi_pool.start()
+            self.poller.register(self.wsgi_pool.fileno(),select.EPOLLIN)
+        self.start_docindex()
+        # SIGHUP only sets a flag and writes to this pipe, so the reload
+        # happens on the loop, between iterations; the profiler signals
+        # share it
+        self.hup_read, self.hup_write = os.pipe()
+        for pipe_fd in (self.hup_read, self.hup_write):
+            fcntl.fcntl(pipe_fd, fcntl.F_SETFL, fcntl.fcntl(pipe_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self.hup_read,select.EPOLLIN)
+        signal.signal(signal.SIGHUP, self.handle_hup)
+        signal.signal(signal.SIGUSR1, self.handle_profiler)
+        signal.signal(signal.SIGUSR2, self.handle_profiler)
         while True:
-            # poll sockets
+            # poll sockets until the nearest client deadline, index rescan
+            # or retry of a paused listener
+            deadline = self.timers.next_deadline()
+            rescan = self.docindex.next_rescan
+            if rescan is not None and (deadline is None or rescan < deadline):
+                deadline = rescan
+            if self.accept_paused is not None and (deadline is None or self.accept_paused < deadline):
+                deadline = self.accept_paused
+            timeout = -1 if deadline is None else max(0, deadline - time.time())
+            polled = time.time()
             try:
-                # poll sockets every half second
-                fds = self.poller.poll(timeout=0.5)
-
-                # update idle time for each client
-                for client in self.clientIdleTime:
-                    self.clientIdleTime[client] += 0.5
+                fds = self.poller.poll(timeout)
+            except (IOError, OSError) as err:
+                if err.errno != errno.EINTR:
+                    self.shutdown()
+                    return
+                # interrupted by a signal
+                fds = []
             except:
+                self.shutdown()
                 return
+            woke = time.time()
+            if woke - polled > 0.001:
+                # the loop was waiting for work, so it isn't behind
+                self.loop_lag = 0.0
             for (fd,event) in fds:
                 # handle errors
                 if event & (select.POLLHUP | select.POLLERR):
@@ -84,216 +237,1374 @@ class Poller:
                 if fd == self.server.fileno():
                     self.handleServer()
                     continue
+                # finish what the disk pool did: files read, gzip built, rescans
+                if self.disk_pool and fd == self.disk_pool.fileno():
+                    self.disk_pool.run_callbacks()
+                    continue
+                # send what WSGI applications returned
+                if self.wsgi_pool and fd == self.wsgi_pool.fileno():
+                    self.wsgi_pool.run_callbacks()
+                    continue
+                # files in the document root changed
+                if fd == self.docindex.fileno():
+                    self.update_docindex()
+                    continue
+                if fd == self.hup_read:
+                    self.drain_hup()
+                    continue
+                # drain queued output for the client socket
+                if event & select.EPOLLOUT:
+                    self.handleWrite(fd)
+                    continue
                 # handle client socket
                 result = self.handleClient(fd)
 
-            ###############################################
-            #             SWEEP -- (MARK & SWEEP)         #
-            # TODO: Kick off clients idle for max timeout #
-            ###############################################
-            # print "clientsIdle...",self.clientIdleTime
-            # print "clients:", self.clients
-
-            fdsToBeDeleted = []
-            for client_fd in self.clientIdleTime:
-                # print "client_fd::::", client_fd
-                if self.clientIdleTime[client_fd] >= self.timeout:
-                    self.poller.unregister(client_fd)
-                    try:
-                        self.clients[client_fd].close()
-                    except:
-                        pass
-                    try:
-                        del self.cache[client_fd]
-                    except:
-                        pass
-                    try:
-                        del self.clients[client_fd]
-                    except:
-                        pass
-                    fdsToBeDeleted.append(client_fd)
+            if rescan is not None and time.time() >= rescan:
+                self.update_docindex()
+            if self.accept_paused is not None and time.time() >= self.accept_paused:
+                self.resume_accepting()
+            if self.reload_pending:
+                self.reload_pending = False
+                self.reload()
+            while self.profiler_pending:
+                self.profiler.handle_signal(self.profiler_pending.pop(0))
 
-            # Delete client time-entries for clients that have been deleted
-            for fd in fdsToBeDeleted:
-                try:
-                    del self.clientIdleTime[fd]
-                except:
-                    pass
+            # drop clients that missed their deadline; only the expired
+            # timers are touched, not every client
+            for client_fd in self.timers.expired(time.time()):
+                conn = self.connections[client_fd]
+                if conn.waiting is not None or (conn.outbound and conn.outbound.stalled()):
+                    # a request is still being worked on, not the client's fault
+                    self.set_deadline(conn, conn.phase, self.timeout)
+                    continue
+                self.metrics.add_timeout(conn.phase)
+                self.close_connection(conn)
+            # events that came in meanwhile have waited this long
+            self.loop_lag = time.time() - woke
+            if self.profiler.lag is not None:
+                self.profiler.add_lag(self.loop_lag)
+
+    def start_docindex(self):
+        """ With inotify, cached files are dropped when they change instead
+        of being checked with stat every cache_revalidate seconds """
+        watching = self.docindex.start()
+        self.filecache.revalidate = None if watching else self.settings["cache_revalidate"]
+        self.watch_docindex(watching)
+
+    def watch_docindex(self, watching):
+        if watching:
+            self.poller.register(self.docindex.fileno(),select.EPOLLIN)
+
+    def stop_docindex(self):
+        if self.docindex.watching():
+            self.poller.unregister(self.docindex.fileno())
+        self.docindex.close()
+
+    def update_docindex(self):
+        docindex = self.docindex
+        if docindex.watching():
+            self.forget_files(docindex.read_events())
+        elif self.disk_pool:
+            self.rescan_on_pool(docindex)
+        else:
+            self.forget_files(docindex.rescan())
+
+    def rescan_on_pool(self, docindex):
+        """ Walk the document root on the disk pool, so a big tree doesn't
+        hold up the loop; the index is updated on the loop afterwards """
+        if docindex.next_rescan is None:
+            # the last walk hasn't come back yet
+            return
+        docindex.next_rescan = None
+
+        def walked(found, error):
+            if docindex is not self.docindex:
+                # replaced by a reload meanwhile
+                return
+            if error:
+                logging.error("Could not rescan %s: %s" % (docindex.root, error))
+                docindex.next_rescan = time.time() + docindex.rescan_interval
+                return
+            self.forget_files(docindex.rescan(found))
 
+        self.disk_pool.submit(docindex.walk, (), walked)
+
+    def forget_files(self, changed):
+        for filename in changed:
+            self.filecache.remove(filename)
+
+    def handle_hup(self, signum, frame):
+        self.reload_pending = True
+        self.wake()
+
+    def handle_profiler(self, signum, frame):
+        self.profiler_pending.append(signum)
+        self.wake()
+
+    def wake(self):
+        try:
+            os.write(self.hup_write, b"x")
+        except OSError:
+            # already woken up
+            pass
+
+    def drain_hup(self):
+        try:
+            while os.read(self.hup_read, 4096):
+                pass
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def shutdown(self):
+        self.profiler.stop()
+        self.docindex.close()
+        if self.access_log:
+            # write out whatever is still buffered
+            self.access_log.close()
 
     def handleError(self,fd):
-        self.poller.unregister(fd)
         if fd == self.server.fileno():
             # recreate server socket
+            self.poller.unregister(fd)
             self.server.close()
             self.open_socket()
             self.poller.register(self.server,self.pollmask)
-        else:
-            # close the socket
-            self.clients[fd].close()
-            del self.cache[fd]
-            del self.clients[fd]
-            # Delete client timestamp on client deletion
-            del self.clientIdleTime[fd]
+        elif fd in self.connections:
+            self.close_connection(self.connections[fd])
+
+    def close_connection(self, conn):
+        """ The one place a client is dropped, whether it hung up, timed
+        out, errored or was sent a response that ends the connection """
+        if conn.state == CLOSED:
+            return
+        conn.state = CLOSED
+        self.poller.unregister(conn.fd)
+        conn.sock.close()
+        if conn.outbound:
+            self.buffered -= conn.outbound.pending
+            for record in conn.outbound.close():
+                self.discard_record(record)
+        del self.connections[conn.fd]
+        self.timers.cancel(conn.fd)
+        self.release_connection(conn.ip)
+        if self.accept_paused is not None:
+            # a descriptor is free again
+            self.resume_accepting()
+
+    def set_deadline(self, conn, phase, timeout):
+        conn.phase = phase
+        conn.phase_requests = conn.requests
+        conn.deadline = time.time() + timeout
+        self.timers.set(conn.fd, conn.deadline)
+
+    def read_deadline(self, buf, requests, phase, phase_requests):
+        """ The deadline a client that is being read from should have next,
+        as (phase, timeout), or None to keep the one it has. A request that
+        is still arriving keeps the deadline it got when it started, so a
+        client trickling in bytes doesn't buy itself more time; one that
+        began after the deadline was set, behind a finished request, gets
+        its own. """
+        partial = buf.partial()
+        if partial is None:
+            if requests:
+                return KEEPALIVE, self.timeout
+            return FIRST_BYTE, self.first_byte_timeout
+        if partial == phase and requests == phase_requests:
+            return None
+        return partial, self.header_timeout if partial == HEADER else self.body_timeout
+
+    def reading(self, conn):
+        """ Set the deadline for what the client is expected to send next """
+        if conn.state != READING or conn.closing or conn.waiting is not None:
+            # writing, closed, or busy with a request and not reading yet
+            return
+        deadline = self.read_deadline(conn.buffer, conn.requests, conn.phase, conn.phase_requests)
+        if deadline:
+            self.set_deadline(conn, *deadline)
 
     def handleServer(self):
-        # accept as many clients as possible
-        while True:
+        # accept up to a batch of clients; the listener is level-triggered,
+        # so any still waiting are accepted on the next wakeup, after the
+        # clients that are ready now have been served
+        for i in range(self.accept_batch):
             try:
                 (client,address) = self.server.accept()
-            except socket.error, (value,message):
+            except socket.error as err:
                 # if socket blocks because no clients are available,
                 # then return
-                if value == errno.EAGAIN or errno.EWOULDBLOCK:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if err.args[0] in (errno.ECONNABORTED, errno.EPROTO):
+                    # the client gave up before it was accepted
+                    continue
+                if err.args[0] in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    self.pause_accepting(err)
                     return
                 logging.error(traceback.format_exc())
                 sys.exit()
+            self.accept_warned = False
+            self.metrics.accepts += 1
+            refused = self.admit_connection(address[0])
+            if refused:
+                self.refuse(client, refused)
+                continue
             # set client socket to be non blocking
             client.setblocking(0)
-            self.clients[client.fileno()] = client
+            self.tune_client(client)
+            conn = Connection(client, address[0], RequestBuffer(self.size, self.max_header, self.max_body))
+            self.connections[conn.fd] = conn
+
+            # the client has this long to start sending a request
+            self.set_deadline(conn, FIRST_BYTE, self.first_byte_timeout)
+            self.poller.register(conn.fd,self.pollmask)
+
+    def pause_accepting(self, err):
+        """ Stop polling the listener, which is level-triggered and would
+        wake the loop straight away, until a client closes or a second
+        has passed """
+        if not self.accept_warned:
+            logging.warning("Could not accept client: %s, pausing accepts" % err)
+            self.accept_warned = True
+        self.poller.unregister(self.server)
+        self.accept_paused = time.time() + 1.0
+
+    def resume_accepting(self):
+        self.accept_paused = None
+        self.poller.register(self.server,self.pollmask)
+
+    def admit_connection(self, ip):
+        """ Count a new client against the connection caps. Returns why it
+        is refused, or None. """
+        if self.max_connections and self.open_clients >= self.max_connections:
+            return "connections"
+        count = self.ip_connections.get(ip, 0)
+        if self.max_connections_per_ip and count >= self.max_connections_per_ip:
+            return "connections_per_ip"
+        self.open_clients += 1
+        self.ip_connections[ip] = count + 1
+        return None
 
-            # Create client timestamp on client creation
-            self.clientIdleTime[client.fileno()] = 0
+    def release_connection(self, ip):
+        self.open_clients -= 1
+        count = self.ip_connections[ip] - 1
+        if count:
+            self.ip_connections[ip] = count
+        else:
+            del self.ip_connections[ip]
+
+    def refuse(self, sock, reason):
+        """ Turn a client away as soon as it is accepted. The 503 is sent
+        without waiting; a client that can't take it just sees the close. """
+        self.metrics.add_shed(reason)
+        try:
+            sock.setblocking(0)
+            sock.send(self.gen_busy("503 Service Unavailable", self.retry_after)[0])
+        except socket.error:
+            pass
+        sock.close()
 
-            self.cache[client.fileno()] = ""
-            self.poller.register(client.fileno(),self.pollmask)
+    def tune_client(self, sock):
+        # with TCP_NODELAY the last small segment of a response isn't held
+        # back waiting for the ACK of the one before
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.tcp_nodelay else 0)
+
+    def set_cork(self, sock, on):
+        """ While corked, the kernel only sends full segments, so a header
+        and body written separately go out together """
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, on)
+        except socket.error:
+            pass
 
     def handleClient(self,fd):
+        conn = self.connections.get(fd)
+        if conn is None:
+            # closed by a pool callback earlier in the same batch of events
+            return
         try:
-            data = self.clients[fd].recv(self.size)
-        except socket.error, (value,message):
+            count = conn.buffer.recv(conn.sock)
+        except socket.error as err:
             # if no data is available, move on to another client
-            if value == errno.EAGAIN or errno.EWOULDBLOCK:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
                 return
-            logging.error(traceback.format_exc())
-            sys.exit()
-
-        if data:
-            # if end of http request found...
-            if "\r\n\r\n" in data:
-                chunks = data.split("\r\n\r\n")
-
-                # adding the \r\n\r\n back into the chunks that had it
-                for i in range(len(chunks)):
-                    if i is not len(chunks)-1:
-                        #logging.debug("adding \\r\\n\\r\\n to %s" % chunks[i])
-                        chunks[i] += "\r\n\r\n"
-
-                # append the last bit of the request to the cache
-                self.cache[fd] += chunks[0]
-                self.handle_request(self.cache[fd], fd)
-                # remove the last bit of the request that we are handling and clear the cache
-                chunks.pop(0)
-                self.cache[fd] = ""
-
-                for req in chunks:
-                    if req.endswith("\r\n\r\n"):
-                        self.handle_request(req, fd)
-                    else:
-                        self.cache[fd] = req
-            else:
-                logging.debug("Appending to cache[%i] += %s" % (fd, data))
-                self.cache[fd] += data
-                if "\r\n\r\n" in self.cache[fd]:
-                    #TODO: check for multiple requests in cache
-                    request_end_index = self.cache[fd].find("\r\n\r\n") + 4
-                    request = self.cache[fd][:request_end_index]
-                    self.handle_request(request, fd)
-                    self.cache[fd] = self.cache[fd][request_end_index:]
-        else:
-            # when does this happen?
-            self.poller.unregister(fd)
-            self.clients[fd].close()
-            del self.cache[fd]
-            del self.clients[fd]
-            # Delete client timestamp on client deletion
-            del self.clientIdleTime[fd]
+            # the connection was reset, drop the client
+            self.close_connection(conn)
+            return
 
+        if not count:
+            # the client closed its end
+            self.close_connection(conn)
+            return
+        conn.received += count
+        self.process_requests(conn)
+        self.reading(conn)
 
-        ##############################################
-        #           MARK -- (MARK & SWEEP)           #
-        # TODO: reset time to 0 for specified client #
-        ##############################################
-        self.clientIdleTime[fd] = 0
+    def process_requests(self, conn):
+        """ Handle each complete request in the client's buffer, in order.
+        Stops early if a request has to wait for the disk or WSGI pool. """
+        buf = conn.buffer
+        while conn.state != CLOSED and not conn.closing and conn.waiting is None:
+            try:
+                req = buf.next_request()
+            except RequestError as err:
+                self.reject(conn.fd, err.status, time.time())
+                break
+            if req is None:
+                break
+            conn.requests += 1
+            self.handle_request(req, conn.fd)
+        buf.release()
+        if conn.parser:
+            # don't hold on to the last request's headers while idle
+            conn.parser.reset()
 
+    def client(self, fd):
+        """ The engine's object for a client, None once it has gone """
+        return self.connections.get(fd)
 
+    def handleWrite(self,fd):
+        conn = self.connections.get(fd)
+        if conn is None or conn.outbound is None:
+            # a stale event, the client was closed or its fd reused since
+            return
+        queue = conn.outbound
+        pending = queue.pending
+        try:
+            sent = queue.flush(conn.sock)
+        except (socket.error, OSError):
+            # the client went away before reading its response
+            self.buffered += queue.pending - pending
+            self.close_connection(conn)
+            return
+        self.buffered += queue.pending - pending
+        self.metrics.bytes_sent += sent
+        self.record_finished(conn)
+        if queue.empty():
+            if conn.closing:
+                self.close_connection(conn)
+                return
+            conn.state = READING
+            # a parked client is read from again once it is resumed
+            self.poller.modify(fd,self.pollmask if conn.waiting is None else self.waitmask)
+            self.reading(conn)
+        elif queue.stalled():
+            self.poller.modify(fd,self.waitmask)
+
+    def resume_output(self, fd):
+        """ A producer's next buffer was made on a pool, send it """
+        if fd in self.connections:
+            self.poller.modify(fd,self.writemask)
+            self.handleWrite(fd)
+
+    def send(self,fd,data):
+        """ Queue data for a client and send as much as possible now. If
+        the socket can't take all of it, wait for EPOLLOUT to send the rest. """
+        conn = self.connections.get(fd)
+        if conn is None:
+            # closed while handling an earlier pipelined request
+            self.close_parts([data])
+            return
+        queue = conn.outbound
+        if queue is None:
+            queue = conn.outbound = OutQueue()
+        was_empty = queue.empty()
+        pending = queue.pending
+        if isinstance(data, Producer):
+            data.wakeup = lambda: self.resume_output(fd)
+        queue.push(data)
+        if not was_empty:
+            # already waiting on EPOLLOUT, keep responses in order
+            self.buffered += queue.pending - pending
+            return
+        try:
+            self.metrics.bytes_sent += queue.flush(conn.sock)
+        except (socket.error, OSError):
+            self.buffered += queue.pending - pending
+            self.close_connection(conn)
+            return
+        self.buffered += queue.pending - pending
+        if not queue.empty():
+            conn.state = WRITING
+            self.poller.modify(fd,self.waitmask if queue.stalled() else self.writemask)
+            # the client has this long to take everything queued, however
+            # it paces its reads
+            self.set_deadline(conn, WRITE, self.write_timeout)
+
+    def send_response(self, fd, response, started, record=None):
+        conn = self.connections.get(fd)
+        if conn is None:
+            self.close_parts(response)
+            self.discard_record(record)
+            return
+        cork = self.tcp_cork and len(response) > 1
+        if cork:
+            self.set_cork(conn.sock, 1)
+        for index, part in enumerate(response):
+            if conn.state == CLOSED:
+                # an earlier part failed, the rest is never queued
+                self.close_parts(response[index:])
+                break
+            self.send(fd,part)
+        if conn.state == CLOSED:
+            self.discard_record(record)
+            return
+        if cork:
+            self.set_cork(conn.sock, 0)
+        if conn.outbound is None:
+            conn.outbound = OutQueue()
+        conn.outbound.mark(started, record)
+        self.record_finished(conn)
+        if conn.closing and conn.state == READING:
+            # all of it went out already
+            self.close_connection(conn)
 
-    def parse_request(self, req):
-        parser = HttpParser()
-        num_parsed = parser.execute(req, len(req))
+    def close_parts(self, parts):
+        """ Release the files and producers of response parts that won't
+        be sent """
+        for part in parts:
+            if isinstance(part, (FileSegment, Producer)):
+                part.close()
+
+    def record_finished(self, conn):
+        now = time.time()
+        queue = conn.outbound
+        for started, record, size in queue.finished():
+            self.metrics.response_time.add(now - started)
+            if record:
+                record[5] = size
+                record[6] = now - started
+                record[8].add(record)
+        if queue.idle():
+            # an idle keep-alive connection doesn't keep its queue
+            conn.outbound = None
+
+    def discard_record(self, record):
+        # the response was never sent in full, so it isn't logged
+        if record:
+            record[8].discard(record)
+
+    def parse_request(self, req, fd):
+        """ The built-in parser raises RequestError for a request it won't
+        handle; HttpParser leaves that to the checks in handle_request """
+        if self.parser == "http-parser":
+            parser = HttpParser()
+            num_parsed = parser.execute(req, len(req))
+            return parser
+        client = self.client(fd)
+        parser = client.parser
+        if parser is None:
+            parser = client.parser = RequestParser(self.max_request_line, self.max_header, self.max_headers)
+        else:
+            parser.reset()
+        parser.execute(req, len(req))
         return parser
 
+    def admit_request(self, fd, started):
+        """ Shed the request before any work is done on it if the server is
+        overloaded or the client is over its rate. Returns False if it was
+        answered that way. """
+        reason = None
+        if self.shed_buffered_bytes and self.buffered > self.shed_buffered_bytes:
+            reason = "buffered_bytes"
+        elif self.shed_loop_lag and self.loop_lag > self.shed_loop_lag:
+            reason = "loop_lag"
+        if reason:
+            self.shed(fd, reason, started)
+            return False
+        if self.rate_limiter:
+            ip = self.client(fd).ip
+            if not self.rate_limiter.allow(ip, started):
+                self.shed(fd, "rate_limit", started, "429 Too Many Requests",
+                    self.rate_limiter.retry_after(ip))
+                return False
+        return True
+
+    def shed(self, fd, reason, started, status="503 Service Unavailable", retry_after=None):
+        """ Answer with a ready-made 503 (or 429) instead of serving the
+        request, then close the connection """
+        self.metrics.add_shed(reason)
+        self.metrics.add_request(status[:3])
+        self.client(fd).closing = True
+        self.send_response(fd, self.gen_busy(status, retry_after or self.retry_after), started)
+
+    def reject(self, fd, status, started):
+        """ Answer a request the parser refused, then close the connection """
+        logging.warning("rejecting request on %i: %s" % (fd, status))
+        self.client(fd).closing = True
+        self.metrics.add_request(status[:3])
+        self.send_response(fd, self.gen_error(status), started)
+
     def rfc_1123_date(self, timestamp=0):
         now = datetime.fromtimestamp(timestamp) if timestamp != 0 else datetime.now()
         stamp = mktime(now.timetuple())
         return format_date_time(stamp)
 
-    def get_filename(self, path):
-        basename, ext = os.path.splitext(path)
-        if basename is "/":
-            basename = "/index"
-            ext = ".html"
-        logging.debug("docRoot: %s, path: %s, basename: %s, ext: %s" % (self.root, path, basename, ext))
-        return (self.root + basename + ext, basename, ext)
-
     def get_file(self, path):
-        filename, basename, ext = self.get_filename(path)
-        if os.path.isfile(filename):
-            try:
-                with open(filename, 'r') as content_file:
-                    response_body = content_file.read()
-                    return (response_body, self.supportedMIMEtypes[ext.strip(".")], "200 OK")
-            except IOError, err:
-                if err.errno is 13:
-                    return ("<html><head><title>Error - Forbidden</title></head><body><h1>Error</h1><h3>%s Forbidden</h3></body></html>" % 
-                        path, self.supportedMIMEtypes["html"], "403 Forbidden")
-                else:
-                    return ("<html><head><title>Error - Internal Server Error</title></head><body><h1>Error</h1><h3>%s Internal Server Error</h3></body></html>" % 
-                        path, self.supportedMIMEtypes["html"], "500 Internal Server Error")
-        else:
-            logging.warn("file not found: %s" % filename)
+        """ Returns (body, mime type, status, cache entry). For 200 responses
+        the body is the cached bytes, the open file, or None if only the
+        file's metadata is cached and it hasn't been opened yet. """
+        try:
+            item = self.docindex.lookup(path)
+        except ValueError:
+            logging.warning("rejecting path outside the document root: %s" % path)
+            return ("<html><head><title>Error - Bad Request</title></head><body><h1>Error</h1><h3>%s Bad Request</h3></body></html>" % path,
+                self.supportedMIMEtypes["html"], "400 Bad Request", None)
+        if item is None:
+            logging.warning("file not found: %s" % path)
             return ("<html><head><title>Error - File Not Found</title></head><body><h1>Error</h1><h3>%s Not Found</h3></body></html>" % path,
-                self.supportedMIMEtypes["html"], "404 Not Found")
+                self.supportedMIMEtypes["html"], "404 Not Found", None)
+        entry = self.filecache.get(item.filename)
+        if entry:
+            return (entry.body, entry.mime_type, "200 OK", entry)
+        try:
+            entry = self.load_file(item.filename, item.mime_type)
+        except IOError as err:
+            return self.file_error(path, err)
+        self.filecache.put(item.filename, entry)
+        # large files are opened by gen_response when it needs the body
+        return (entry.body, entry.mime_type, "200 OK", entry)
+
+    def load_file(self, filename, mime_type):
+        """ Read a file's metadata, and its body if it is small enough to
+        cache. This blocks, so it may run on the disk pool. """
+        with open(filename, 'rb') as content_file:
+            info = os.fstat(content_file.fileno())
+            entry = CacheEntry(filename, None, mime_type,
+                self.rfc_1123_date(info.st_mtime), info.st_size, info.st_mtime, info.st_ino)
+            if info.st_size <= self.cache_max_file:
+                entry.body = content_file.read()
+        return entry
+
+    def open_file(self, path, entry):
+        """ Open a file whose metadata was cached without its body """
+        try:
+            return (open(entry.path, 'rb'), entry.mime_type, "200 OK", entry)
+        except IOError as err:
+            self.filecache.remove(entry.path)
+            return self.file_error(path, err)
 
-    def gen_response(self, url, method):
-        path = urlparse(url).path
+    def file_error(self, path, err):
+        if err.errno == errno.EACCES:
+            return ("<html><head><title>Error - Forbidden</title></head><body><h1>Error</h1><h3>%s Forbidden</h3></body></html>" % 
+                path, self.supportedMIMEtypes["html"], "403 Forbidden", None)
+        else:
+            return ("<html><head><title>Error - Internal Server Error</title></head><body><h1>Error</h1><h3>%s Internal Server Error</h3></body></html>" % 
+                path, self.supportedMIMEtypes["html"], "500 Internal Server Error", None)
+
+    def gen_response(self, url, method, req_headers=None, version=(1, 1)):
+        parsed = urlparse(url)
+        path = parsed.path
+        entry = None
         if path == "" or method == "":
             body, mime_type, status = (
                 "<html><head><title>Error - Bad Request</title></head><body><h1>Error</h1><h3>%s Bad Request</h3></body></html>" % path,
                     self.supportedMIMEtypes["html"], "400 Bad Request")
-        elif method != "GET":
+        elif method != "GET" and method != "HEAD":
             body, mime_type, status = (
                 "<html><head><title>Error - Not Implemented</title></head><body><h1>Error</h1><h3>%s Not Implemented</h3></body></html>" % path,
                     self.supportedMIMEtypes["html"], "501 Not Implemented")
+        elif path == self.stats_path:
+            return self.gen_stats(parsed.query, method)
+        else:
+            started = time.time()
+            stream = False
+            body, mime_type, status, entry = self.get_file(path)
+            self.metrics.lookup_time.add(time.time() - started)
+            if (entry and req_headers and not req_headers.get("Range")
+                    and self.accepts_gzip(req_headers)):
+                variant = self.get_gzip_variant(entry)
+                if variant:
+                    if hasattr(body, "close"):
+                        body.close()
+                    body, entry = variant.body, variant
+                elif self.gzip_stream and version >= (1, 1) and self.streams_gzip(entry):
+                    stream = True
+            if entry and req_headers and self.is_not_modified(req_headers, entry):
+                # revalidation answered from cached metadata, the file is never opened
+                if hasattr(body, "close"):
+                    body.close()
+                return [self.status_line("304 Not Modified") + self.date_headers() +
+                    self.validator_headers(entry) + b"\r\n"]
+            if entry and body is None and method == "GET":
+                body, mime_type, status, entry = self.open_file(path, entry)
+            if stream and entry:
+                if isinstance(body, bytes):
+                    # cached after all, with a bigger cache_max_file
+                    body = io.BytesIO(body)
+                return self.gen_gzip_stream(body, entry, method)
+        if entry:
+            if method == "HEAD":
+                if hasattr(body, "close"):
+                    body.close()
+                body = None
+            ranges = None
+            if body is not None and req_headers and req_headers.get("Range") and self.is_range_current(req_headers, entry):
+                ranges = self.parse_range(req_headers.get("Range"), entry.length)
+            if ranges is not None:
+                return self.gen_range_response(body, entry, ranges)
+            if entry.body is None and body is not None:
+                # send the file body with sendfile instead of reading it in
+                body = FileSegment(body, 0, entry.length)
+            head = self.status_line(status) + self.date_headers() + self.entry_headers(entry)
+        else:
+            # an error page, which echoes the path as it was received
+            body = to_bytes(body)
+            head = (self.status_line(status) + self.date_headers() +
+                to_bytes("Content-Length: %i\r\nContent-Type: %s\r\n\r\n" % (len(body), mime_type)))
+        if method == "HEAD":
+            return [head]
+        return [head, body]
+
+    def connection_gauges(self):
+        idle = 0
+        writing = 0
+        waiting = 0
+        for conn in self.connections.values():
+            if conn.state == WRITING:
+                writing += 1
+            elif conn.buffer.empty():
+                idle += 1
+            if conn.waiting is not None:
+                waiting += 1
+        return {"connections": len(self.connections), "idle_connections": idle,
+            "writing_connections": writing, "disk_waiting": waiting, "timers": len(self.timers)}
+
+    def gen_stats(self, query, method):
+        """ Metrics as Prometheus text, or JSON with ?format=json """
+        gauges = self.connection_gauges()
+        if self.disk_pool:
+            gauges["disk_queue"] = self.disk_pool.pending()
+        if self.wsgi_pool:
+            gauges["wsgi_queue"] = self.wsgi_pool.pending()
+        gauges["buffered_bytes"] = self.buffered
+        gauges["loop_lag_seconds"] = self.loop_lag
+        if self.rate_limiter:
+            gauges["rate_limited_clients"] = len(self.rate_limiter.buckets)
+        gauges["config_reloads"] = self.reloads
+        gauges["docindex_files"] = len(self.docindex.files)
+        gauges["docindex_negative"] = len(self.docindex.negative)
+        if self.access_log:
+            gauges["access_log_dropped"] = self.access_log.dropped
+        caches = {"files": self.filecache.stats(), "gzip": self.gzcache.stats()}
+        if "format=json" in query:
+            body = self.metrics.json(gauges, caches)
+            mime_type = "application/json"
+        else:
+            body = self.metrics.prometheus(gauges, caches)
+            mime_type = "text/plain; version=0.0.4"
+        body = to_bytes(body)
+        head = (self.status_line("200 OK") + self.date_headers() +
+            to_bytes("Content-Length: %i\r\nContent-Type: %s\r\nCache-Control: no-store\r\n\r\n" %
+                (len(body), mime_type)))
+        if method == "HEAD":
+            return [head]
+        return [head, body]
+
+    def status_line(self, status):
+        line = STATUS_LINES.get(status)
+        if line is None:
+            line = STATUS_LINES[status] = to_bytes("HTTP/1.1 %s\r\n" % status)
+        return line
+
+    def date_headers(self):
+        """ Date and Server headers, formatted at most once a second """
+        now = int(time.time())
+        if now != self.date_second:
+            self.date_second = now
+            self.date_block = to_bytes("Date: %s\r\nServer: %s\r\n" % (format_date_time(now), SERVER))
+        return self.date_block
+
+    def validator_headers(self, entry):
+        """ Headers a cache needs to revalidate a file response """
+        if entry.validators is None:
+            entry.validators = to_bytes("Last-Modified: %s\r\nETag: %s\r\n"
+                "Accept-Ranges: bytes\r\nVary: Accept-Encoding\r\n" % (entry.last_modified, entry.etag))
+        return entry.validators
+
+    def entry_headers(self, entry):
+        """ The rest of a 200 response head for a file, blank line included.
+        It only changes with the file, so it is kept on the cache entry. """
+        if entry.headers is None:
+            headers = "Content-Length: %i\r\nContent-Type: %s\r\n" % (entry.length, entry.mime_type)
+            if entry.encoding:
+                headers += "Content-Encoding: %s\r\n" % entry.encoding
+            entry.headers = to_bytes(headers) + self.validator_headers(entry) + b"\r\n"
+        return entry.headers
+
+    def gen_streamed(self, status, headers, iterable, method, length=None, chunked=True, pool=None):
+        """ Response whose body is produced from an iterable of buffers as
+        the client takes it, on the pool if one is given. Without a length
+        it is sent chunked, which only HTTP/1.1 clients understand, or else
+        ended by closing the connection, which the caller has to arrange. """
+        if length is not None:
+            framing = to_bytes("Content-Length: %i\r\n" % length)
+        elif chunked:
+            framing = b"Transfer-Encoding: chunked\r\n"
         else:
-            body, mime_type, status = self.get_file(path)
-        date_header = "Date: %s\r\n" % self.rfc_1123_date()
-        server_header = "Server: %s\r\n" % "python small server 1.0"
-        type_header = "Content-Type: %s\r\n" % mime_type
-        length_header = "Content-Length: %i\r\n" % len(body)
-        headers = date_header + server_header + length_header + type_header
-        if status.startswith("200"):
-            last_modified_header = "Last-Modified: %s\r\n" % self.rfc_1123_date(os.path.getmtime(self.get_filename(path)[0]))
-            headers += last_modified_header
-
-        head = "HTTP/1.1 %s\r\n%s\r\n" % (status, headers)
-        return head + body
-
-    def handle_request(self, req, fd):
-        parser = self.parse_request(req)
+            framing = b"Connection: close\r\n"
+        head = self.status_line(status) + self.date_headers() + framing + headers + b"\r\n"
+        if method == "HEAD":
+            producer = Producer(iterable)
+            producer.close()
+            return [head]
+        return [head, Producer(iterable, chunked=length is None and chunked, pool=pool)]
+
+    def streams_gzip(self, entry):
+        """ Too big to compress into the gzip cache, but worth compressing """
+        return entry.mime_type in self.compressible and entry.length > self.gzip_max_file
+
+    def gen_gzip_stream(self, content_file, entry, method):
+        """ Compress a large file while it is sent. The compressed length
+        isn't known up front, so it goes out chunked; and as the bytes
+        aren't kept, there is no ETag for the variant. Reading and
+        compressing happen on the disk pool when there is one. """
+        headers = to_bytes("Content-Type: %s\r\nContent-Encoding: gzip\r\nLast-Modified: %s\r\n"
+            "Vary: Accept-Encoding\r\n" % (entry.mime_type, entry.last_modified))
+        return self.gen_streamed("200 OK", headers, self.compress_file(content_file), method,
+            pool=self.disk_pool)
+
+    def compress_file(self, content_file, size=1024 * 64):
+        """ Generator of the gzipped file, read a block at a time """
+        try:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            while True:
+                data = content_file.read(size)
+                if not data:
+                    break
+                data = compressor.compress(data)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            content_file.close()
+
+    def accepts_gzip(self, req_headers):
+        """ Check Accept-Encoding for gzip with a non-zero quality """
+        value = req_headers.get("Accept-Encoding")
+        if not value:
+            return False
+        for item in value.split(","):
+            coding, sep, params = item.partition(";")
+            if coding.strip().lower() not in ("gzip", "x-gzip", "*"):
+                continue
+            params = params.replace(" ", "")
+            if params.startswith("q="):
+                try:
+                    return float(params[2:]) > 0
+                except ValueError:
+                    return False
+            return True
+        return False
+
+    def get_gzip_variant(self, entry):
+        """ Returns a cache entry for the gzipped file, or None if there is
+        no worthwhile variant. Variants are built once per version of the
+        file and of its precompressed sibling. """
+        key, sibling = self.gzip_key(entry, self.gzip_sibling(entry.path))
+        if sibling is None and entry.gzip is False:
+            return None
+        variant = self.gzcache.get(key)
+        if variant:
+            return variant
+        variant = self.load_gzip_variant(entry, sibling)
+        self.add_gzip_variant(entry, key, sibling, variant)
+        return variant
+
+    def gzip_sibling(self, filename):
+        """ The index entry for a precompressed copy next to a file; the
+        index knows its version without a stat """
+        return self.docindex.lookup(filename[len(self.docindex.root):] + ".gz")
+
+    def gzip_key(self, entry, sibling):
+        """ Returns the gzcache key for the file's variant, and the sibling
+        if it is current. A replaced or deleted .gz gets a new key rather
+        than being served. """
+        if sibling is not None and sibling.mtime < entry.mtime:
+            # older than the file it was made from
+            sibling = None
+        if sibling is None:
+            return (entry.path, entry.mtime), None
+        return (entry.path, entry.mtime, sibling.inode, sibling.mtime, sibling.length), sibling
+
+    def add_gzip_variant(self, entry, key, sibling, variant):
+        if variant is not None:
+            self.gzcache.put(key, variant)
+        elif sibling is None:
+            # remembered until the file changes and the entry is replaced
+            entry.gzip = False
+
+    def load_gzip_variant(self, entry, sibling):
+        # prefer a precompressed file next to the original
+        info = None
+        if sibling is not None:
+            try:
+                info = os.stat(sibling.filename)
+            except OSError:
+                pass
+        if info and info.st_mtime >= entry.mtime:
+            body = None
+            if info.st_size <= self.cache_max_file:
+                try:
+                    with open(sibling.filename, 'rb') as content_file:
+                        body = content_file.read()
+                except IOError:
+                    return None
+            return CacheEntry(sibling.filename, body, entry.mime_type, entry.last_modified,
+                info.st_size, info.st_mtime, info.st_ino, encoding="gzip")
+
+        # otherwise compress it ourselves, once
+        if entry.mime_type not in self.compressible or entry.length > self.gzip_max_file:
+            return None
+        body = entry.body
+        if body is None:
+            try:
+                with open(entry.path, 'rb') as content_file:
+                    body = content_file.read()
+            except IOError:
+                return None
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+        if len(compressed) >= entry.length:
+            return None
+        return CacheEntry(None, compressed, entry.mime_type, entry.last_modified,
+            len(compressed), entry.mtime, entry.inode, encoding="gzip")
+
+    def is_not_modified(self, req_headers, entry):
+        """ Check If-None-Match and If-Modified-Since against the entry """
+        if_none_match = req_headers.get("If-None-Match")
+        if if_none_match:
+            # If-Modified-Since is ignored when If-None-Match is present
+            if if_none_match.strip() == "*":
+                return True
+            # weak comparison, W/"x" matches "x"
+            etag = entry.etag
+            for tag in if_none_match.split(","):
+                tag = tag.strip()
+                if tag.startswith("W/"):
+                    tag = tag[2:]
+                if tag == etag:
+                    return True
+            return False
+        if_modified_since = req_headers.get("If-Modified-Since")
+        if if_modified_since:
+            since = self.parse_http_date(if_modified_since)
+            return since is not None and int(entry.mtime) <= since
+        return False
+
+    def is_range_current(self, req_headers, entry):
+        """ Check If-Range; a stale validator means the whole file is sent """
+        if_range = req_headers.get("If-Range")
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            # strong comparison only
+            return if_range == entry.etag
+        since = self.parse_http_date(if_range)
+        return since is not None and int(entry.mtime) == since
+
+    def parse_http_date(self, value):
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return mktime_tz(parsed)
+
+    def parse_range(self, value, length):
+        """ Parse a Range header into a list of (first, last) byte positions.
+        Returns None if the header should be ignored and the whole file sent,
+        or an empty list if none of the ranges can be satisfied. """
+        if not value.startswith("bytes="):
+            return None
+        specs = value[len("bytes="):].split(",")
+        if len(specs) > self.max_ranges:
+            return None
+        ranges = []
+        for spec in specs:
+            first, sep, last = spec.strip().partition("-")
+            if not sep or (first and not first.isdigit()) or (last and not last.isdigit()):
+                return None
+            if not first:
+                if not last:
+                    return None
+                # suffix range, the last n bytes
+                count = int(last)
+                if count:
+                    ranges.append((max(0, length - count), length - 1))
+                continue
+            first = int(first)
+            if last:
+                if int(last) < first:
+                    return None
+                last = min(int(last), length - 1)
+            else:
+                last = length - 1
+            if first < length:
+                ranges.append((first, last))
+        return ranges
+
+    def gen_range_response(self, body, entry, ranges):
+        """ 206 response with just the requested parts of a file, taken from
+        the cached body or sent from the open file at an offset. """
+        headers = self.date_headers() + self.validator_headers(entry)
+        if not ranges:
+            if entry.body is None:
+                body.close()
+            headers += to_bytes("Content-Range: bytes */%i\r\nContent-Length: 0\r\n\r\n" % entry.length)
+            return [self.status_line("416 Requested Range Not Satisfiable") + headers]
+
+        parts = []
+        for index, (first, last) in enumerate(ranges):
+            if entry.body is not None:
+                parts.append(memoryview(entry.body)[first:last + 1])
+            else:
+                # the parts share the open file, the last one closes it
+                parts.append(FileSegment(body, first, last - first + 1, owner=index == len(ranges) - 1))
+
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            headers += to_bytes("Content-Type: %s\r\nContent-Range: bytes %i-%i/%i\r\nContent-Length: %i\r\n\r\n" %
+                (entry.mime_type, first, last, entry.length, len(parts[0])))
+            return [self.status_line("206 Partial Content") + headers, parts[0]]
+
+        # several ranges go out as multipart/byteranges
+        response = []
+        for (first, last), part in zip(ranges, parts):
+            response.append(to_bytes("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %i-%i/%i\r\n\r\n" %
+                (self.boundary, entry.mime_type, first, last, entry.length)))
+            response.append(part)
+        response.append(to_bytes("\r\n--%s--\r\n" % self.boundary))
+        headers += to_bytes("Content-Type: multipart/byteranges; boundary=%s\r\nContent-Length: %i\r\n\r\n" %
+            (self.boundary, sum(len(part) for part in response)))
+        return [self.status_line("206 Partial Content") + headers] + response
+
+    def gen_error(self, status, close=True):
+        """ Response for a request that failed before there was anything
+        to send. A request rejected before it could be parsed also closes
+        the connection once this has been sent. """
+        reason = status.split(' ', 1)[1]
+        body = to_bytes("<html><head><title>Error - %s</title></head><body><h1>Error</h1><h3>%s</h3></body></html>" % (reason, reason))
+        head = (self.status_line(status) + self.date_headers() +
+            to_bytes("Content-Length: %i\r\nContent-Type: %s\r\n%s\r\n" %
+                (len(body), self.supportedMIMEtypes["html"], "Connection: close\r\n" if close else "")))
+        return [head, body]
+
+    def gen_busy(self, status, retry_after):
+        """ 503 or 429 with a Retry-After. Everything after the Date header
+        is built once per status and delay, so turning load away costs
+        next to nothing. """
+        key = (status, retry_after)
+        tail = self.busy_tails.get(key)
+        if tail is None:
+            reason = status.split(' ', 1)[1]
+            body = "<html><head><title>Error - %s</title></head><body><h1>Error</h1><h3>%s</h3></body></html>" % (reason, reason)
+            tail = self.busy_tails[key] = to_bytes("Retry-After: %i\r\nContent-Length: %i\r\nContent-Type: %s\r\n"
+                "Connection: close\r\n\r\n%s" % (retry_after, len(body), self.supportedMIMEtypes["html"], body))
+        return [self.status_line(status) + self.date_headers() + tail]
+
+    def handle_request(self, req, fd, loaded=False):
+        started = time.time()
+        if not loaded and not self.admit_request(fd, started):
+            return
+        try:
+            parser = self.parse_request(req, fd)
+        except RequestError as err:
+            self.reject(fd, err.status, started)
+            return
         req_headers = parser.get_headers()
+        self.metrics.parse_time.add(time.time() - started)
+        if self.wsgi_apps:
+            app = self.find_app(parser.get_path())
+            if app:
+                self.call_app(app, req, fd, parser, started)
+                return
+        if self.disk_pool and not loaded and self.defer_to_disk(req, fd, parser):
+            return
         
         if not parser.is_headers_complete() or parser.is_partial_body() or not parser.is_message_complete():
             logging.error("Error parsing request")
             logging.info("Request: %s" % req)
             response = "<html><head><title>Error - Bad Request</title></head><body><h1>Error</h1><h3>Bad Request</h3></body></html>"
-        response = self.gen_response(parser.get_url(), parser.get_method())
+        hits = self.filecache.hits
+        response = self.gen_response(parser.get_url(), parser.get_method(), req_headers, parser.get_version())
             
-        logging.debug(response)
-        self.clients[fd].send(response)
+        logging.debug(response[0])
+        self.finish_request(fd, parser.get_method(), parser.get_path(), response, started,
+            self.filecache.hits > hits)
+
+    def finish_request(self, fd, method, path, response, started, cache_hit=False):
+        status = int(response[0][9:12])
+        self.metrics.add_request("%i" % status)
+        record = None
+        if self.access_log:
+            # the size and duration are filled in once the last byte has been sent
+            record = self.access_log.new_record(started, fd, method, path, status, cache_hit)
+        self.send_response(fd, response, started, record)
+
+    def find_app(self, path):
+        if path:
+            for app in self.wsgi_apps:
+                if app.matches(path):
+                    return app
+        return None
+
+    def call_app(self, app, req, fd, parser, started):
+        """ Run a request through a WSGI application on the pool. Later
+        requests from the client wait for it, as for the disk pool. When
+        the pool is backed up the request is turned away with a 503 rather
+        than queued without bound. """
+        if self.wsgi_pool.pending() >= self.wsgi_queue:
+            self.shed(fd, "wsgi_queue", started)
+            return
+        client = self.client(fd)
+        method = parser.get_method()
+        path = parser.get_path()
+        version = parser.get_version()
+        try:
+            remote = client.sock.getpeername()
+        except socket.error:
+            remote = ("", 0)
+        environ = app.environ(method, path, parser.get_query_string(), parser.get_headers(),
+            parser.recv_body(), version, (self.host, self.port), remote, self.multiprocess)
+        self.park(client, req)
+
+        def done(result, error):
+            if self.client(fd) is not client:
+                # the client went away while the application ran
+                if result and hasattr(result[2], "close"):
+                    result[2].close()
+                return
+            client.waiting = None
+            response = None
+            if not error:
+                try:
+                    response = self.gen_app_response(result, method, version, client)
+                except ValueError as err:
+                    # a header that can't be sent as latin-1
+                    logging.error("WSGI application %s returned bad headers: %s" % (app.spec, err))
+                    if hasattr(result[2], "close"):
+                        result[2].close()
+            if response is None:
+                response = self.gen_error("500 Internal Server Error", close=False)
+            self.finish_request(fd, method, path, response, started)
+            self.resume_client(fd)
+
+        self.wsgi_pool.submit(app.call, (environ,), done)
+
+    def gen_app_response(self, result, method, version, client):
+        """ Response for what a WSGI application returned. The body is sent
+        with its length when that is known, chunked to HTTP/1.1 clients
+        otherwise, and to HTTP/1.0 clients by closing the connection. A
+        streamed body is made on the WSGI pool, a buffer at a time. 1xx,
+        204 and 304 responses go out without a body. """
+        status, app_headers, body = result
+        length = None
+        headers = []
+        for name, value in app_headers:
+            lower = name.lower()
+            if lower == "content-length" and value.isdigit():
+                length = int(value)
+            elif lower not in HOP_HEADERS:
+                headers.append("%s: %s\r\n" % (name, value))
+        headers = to_bytes("".join(headers))
+        code = status[:3]
+        if code[0] == "1" or code == "204" or code == "304":
+            # these never have a body, so no length or framing either
+            Producer(body).close()
+            return [self.status_line(status) + self.date_headers() + headers + b"\r\n"]
+        if isinstance(body, list):
+            if length is None:
+                length = sum(len(data) for data in body)
+            head = (self.status_line(status) + self.date_headers() +
+                to_bytes("Content-Length: %i\r\n" % length) + headers + b"\r\n")
+            if method == "HEAD":
+                return [head]
+            return [head] + body
+        if length is None and version < (1, 1):
+            client.closing = True
+            return self.gen_streamed(status, headers, body, method, chunked=False, pool=self.wsgi_pool)
+        return self.gen_streamed(status, headers, body, method, length, pool=self.wsgi_pool)
+
+    def defer_to_disk(self, req, fd, parser):
+        """ Hand a request for a file that isn't cached, or whose gzip
+        variant has yet to be built, to the disk pool. The request is
+        handled again once that is done; later requests from the same
+        client wait so responses stay in order. """
+        method = parser.get_method()
+        if method != "GET" and method != "HEAD":
+            return False
+        path = urlparse(parser.get_url()).path
+        if path == "" or path == self.stats_path:
+            return False
+        try:
+            item = self.docindex.lookup(path)
+        except ValueError:
+            return False
+        if item is None:
+            return False
+        entry = self.filecache.peek(item.filename)
+        req_headers = parser.get_headers()
+        sibling = None
+        gzip = not req_headers.get("Range") and self.accepts_gzip(req_headers)
+        if gzip:
+            sibling = self.gzip_sibling(item.filename)
+            if entry:
+                key, current = self.gzip_key(entry, sibling)
+                gzip = not (current is None and entry.gzip is False) and self.gzcache.peek(key) is None
+        if entry and not gzip:
+            # answered without touching the disk
+            return False
+        filename = item.filename
+        client = self.client(fd)
+        self.park(client, req)
+
+        def loaded(result, error):
+            if self.client(fd) is not client:
+                # the client went away while the file was being read
+                return
+            client.waiting = None
+            if result:
+                file_entry, variant = result
+                if entry is None:
+                    self.filecache.put(filename, file_entry)
+                if gzip:
+                    key, current = self.gzip_key(file_entry, sibling)
+                    self.add_gzip_variant(file_entry, key, current, variant)
+            # errors are handled inline, where the right response is built
+            self.handle_request(req, fd, loaded=True)
+            self.resume_client(fd)
+
+        self.disk_pool.submit(self.load_for_request, (item, entry, sibling, gzip), loaded)
+        return True
+
+    def load_for_request(self, item, entry, sibling, gzip):
+        """ The disk pool's part of a request: read the file unless it is
+        cached, and build its gzip variant if the client takes one. Returns
+        (cache entry, variant or None). """
+        if entry is None:
+            entry = self.load_file(item.filename, item.mime_type)
+        variant = None
+        if gzip:
+            key, current = self.gzip_key(entry, sibling)
+            if current is not None or entry.gzip is not False:
+                variant = self.load_gzip_variant(entry, current)
+        return entry, variant
+
+    def park(self, conn, req):
+        """ Hold the client's later requests until this one is done, and
+        stop reading from it meanwhile: the buffer isn't checked against
+        the request limits while nothing is taken from it """
+        conn.waiting = req
+        if conn.state == READING:
+            self.poller.modify(conn.fd,self.waitmask)
+
+    def resume_client(self, fd):
+        conn = self.connections.get(fd)
+        if conn:
+            if conn.state == READING:
+                self.poller.modify(fd,self.pollmask)
+            self.process_requests(conn)
+            self.reading(conn)
 
 ########### PARSING CONFIG FILE ################
 
+    # settings that are only read when the listener or disk pool is set up
+    restart_settings = ("host", "listen_backlog", "rcvbuf", "sndbuf", "tcp_defer_accept", "disk_threads",
+        "wsgi", "wsgi_threads")
+
+    def read_config(self):
+        """ Parse and check web.conf. Raises ConfigError rather than exiting
+        so a bad edit can be rejected on reload. """
+        configs = self.parse_conf_file()
+        settings = {
+            "host": self.get_host(configs),
+            "root": self.get_root(configs),
+            "mime_types": self.get_supportedMIMEtypes(configs),
+            "compressible": self.get_compressible(configs),
+            "timeout": self.get_timeout(configs),
+            # the other client deadlines, timeout is the keep-alive one
+            "first_byte_timeout": self.get_parameter(configs, "first_byte_timeout", 10.0, float),
+            "header_timeout": self.get_parameter(configs, "header_timeout", 10.0, float),
+            "body_timeout": self.get_parameter(configs, "body_timeout", 30.0, float),
+            "write_timeout": self.get_parameter(configs, "write_timeout", 60.0, float),
+            # listener and client socket tuning
+            "listen_backlog": self.get_parameter(configs, "listen_backlog", socket.SOMAXCONN),
+            # accepting is spread over wakeups so a connection storm can't
+            # starve clients that are already connected
+            "accept_batch": self.get_parameter(configs, "accept_batch", 64),
+            "tcp_nodelay": self.get_parameter(configs, "tcp_nodelay", 1),
+            "tcp_defer_accept": self.get_parameter(configs, "tcp_defer_accept", 0),
+            "tcp_cork": self.get_parameter(configs, "tcp_cork", 1),
+            "rcvbuf": self.get_parameter(configs, "rcvbuf", 0),
+            "sndbuf": self.get_parameter(configs, "sndbuf", 0),
+            # overload protection, 0 turns each limit off
+            "max_connections": self.get_parameter(configs, "max_connections", 0),
+            "max_connections_per_ip": self.get_parameter(configs, "max_connections_per_ip", 0),
+            # token bucket per client address, requests a second and burst
+            "rate_limit": self.get_parameter(configs, "rate_limit", 0, float),
+            "rate_burst": self.get_parameter(configs, "rate_burst", 100),
+            # requests get a 503 while this much response data is queued
+            # in memory, or while the loop is this many seconds behind
+            "shed_buffered_bytes": self.get_parameter(configs, "shed_buffered_bytes", 0),
+            "shed_loop_lag": self.get_parameter(configs, "shed_loop_lag", 0, float),
+            "retry_after": self.get_parameter(configs, "retry_after", 1),
+            "docindex_rescan": self.get_parameter(configs, "docindex_rescan", 5.0, float),
+            # where SIGUSR1 and SIGUSR2 write the profile and phase timings
+            "profile_dir": self.get_parameter(configs, "profile_dir", tempfile.gettempdir(), str),
+            "docindex_inotify": self.get_parameter(configs, "docindex_inotify", 1),
+            "cache_bytes": self.get_parameter(configs, "cache_bytes", 1024 * 1024 * 16),
+            "cache_revalidate": self.get_parameter(configs, "cache_revalidate", 1.0, float),
+            # files bigger than this are sent from disk, only their metadata is cached
+            "cache_max_file": self.get_parameter(configs, "cache_max_file", 1024 * 1024),
+            "gzip_cache_bytes": self.get_parameter(configs, "gzip_cache_bytes", 1024 * 1024 * 8),
+            "gzip_max_file": self.get_parameter(configs, "gzip_max_file", 1024 * 1024 * 4),
+            # compress bigger files while sending them, chunked, instead
+            "gzip_stream": self.get_parameter(configs, "gzip_stream", 0),
+            "max_header_bytes": self.get_parameter(configs, "max_header_bytes", 1024 * 8),
+            "max_body_bytes": self.get_parameter(configs, "max_body_bytes", 1024 * 1024),
+            # limits for the built-in parser
+            "max_request_line": self.get_parameter(configs, "max_request_line", 1024 * 8),
+            "max_headers": self.get_parameter(configs, "max_headers", 100),
+            # internal path serving the metrics, None to disable it
+            "stats_path": self.get_parameter(configs, "stats_path", None, str),
+            "disk_threads": self.get_parameter(configs, "disk_threads", 0),
+            # (prefix, "module:callable") for each mounted application
+            "wsgi": self.get_wsgi_mounts(configs),
+            "wsgi_threads": self.get_parameter(configs, "wsgi_threads", 4),
+            # requests waiting for a thread before more are refused
+            "wsgi_queue": self.get_parameter(configs, "wsgi_queue", 64),
+            "access_log": self.get_parameter(configs, "access_log", None, str),
+            "access_log_buffer": self.get_parameter(configs, "access_log_buffer", 10000),
+        }
+        if not os.path.isdir(settings["root"]):
+            raise ConfigError("Document root %s is not a directory" % settings["root"])
+        if "html" not in settings["mime_types"]:
+            # error pages are sent as html
+            raise ConfigError("web.conf needs a media line for html")
+        for name in ("timeout", "first_byte_timeout", "header_timeout", "body_timeout", "write_timeout",
+                "docindex_rescan"):
+            if settings[name] <= 0:
+                raise ConfigError("%s must be positive" % name)
+        return settings
+
+    def apply_settings(self, settings):
+        """ Copy the settings that are read per request or per connection """
+        self.host = settings["host"]
+        self.root = settings["root"]
+        self.supportedMIMEtypes = settings["mime_types"]
+        self.compressible = settings["compressible"]
+        self.timeout = settings["timeout"]
+        self.first_byte_timeout = settings["first_byte_timeout"]
+        self.header_timeout = settings["header_timeout"]
+        self.body_timeout = settings["body_timeout"]
+        self.write_timeout = settings["write_timeout"]
+        self.listen_backlog = settings["listen_backlog"]
+        self.profile_dir = settings["profile_dir"]
+        self.accept_batch = settings["accept_batch"]
+        self.tcp_nodelay = settings["tcp_nodelay"]
+        self.tcp_defer_accept = settings["tcp_defer_accept"]
+        self.tcp_cork = settings["tcp_cork"] and hasattr(socket, "TCP_CORK")
+        self.rcvbuf = settings["rcvbuf"]
+        self.sndbuf = settings["sndbuf"]
+        self.cache_max_file = settings["cache_max_file"]
+        self.gzip_max_file = settings["gzip_max_file"]
+        self.gzip_stream = settings["gzip_stream"]
+        self.max_header = settings["max_header_bytes"]
+        self.max_body = settings["max_body_bytes"]
+        self.max_request_line = settings["max_request_line"]
+        self.max_headers = settings["max_headers"]
+        self.stats_path = settings["stats_path"]
+        self.wsgi_queue = settings["wsgi_queue"]
+        self.max_connections = settings["max_connections"]
+        self.max_connections_per_ip = settings["max_connections_per_ip"]
+        self.shed_buffered_bytes = settings["shed_buffered_bytes"]
+        self.shed_loop_lag = settings["shed_loop_lag"]
+        self.retry_after = settings["retry_after"]
+        limiter = getattr(self, "rate_limiter", None)
+        if settings["rate_limit"] <= 0:
+            self.rate_limiter = None
+        elif not limiter or (limiter.rate, limiter.burst) != (settings["rate_limit"], max(1, settings["rate_burst"])):
+            # an unchanged limit keeps its buckets over a reload
+            self.rate_limiter = RateLimiter(settings["rate_limit"], settings["rate_burst"])
+        # ready-made 503 and 429 responses, the error page type may change
+        self.busy_tails = {}
+
+    def new_docindex(self, settings):
+        return DocIndex(settings["root"], settings["mime_types"],
+            settings["docindex_rescan"], settings["docindex_inotify"])
+
+    def new_wsgi_apps(self, settings):
+        apps = []
+        for prefix, spec in settings["wsgi"]:
+            try:
+                apps.append(WsgiApp(prefix, spec))
+            except Exception as err:
+                raise ConfigError("Could not load WSGI application %s: %s" % (spec, err))
+        apps.sort(key=lambda app: len(app.prefix), reverse=True)
+        return apps
+
+    def new_access_log(self, settings):
+        if not settings["access_log"]:
+            return None
+        return AccessLog(settings["access_log"], settings["access_log_buffer"])
+
+    def reload(self):
+        """ Re-read web.conf on SIGHUP. Connections are kept, and caches are
+        only emptied when a setting their contents depend on has changed. """
+        try:
+            settings = self.read_config()
+        except ConfigError as err:
+            logging.error("Not reloading web.conf: %s" % err)
+            return False
+        old = self.settings
+        changed = set(name for name in settings if settings[name] != old[name])
+        fixed = changed.intersection(self.restart_settings)
+        if fixed:
+            logging.warning("Restart to change %s" % ", ".join(sorted(fixed)))
+            for name in fixed:
+                settings[name] = old[name]
+            changed -= fixed
+        # opened before anything changes, so a bad path rejects the reload
+        access_log = self.new_access_log(settings)
+        if access_log:
+            try:
+                access_log.open()
+            except OSError as err:
+                logging.error("Not reloading web.conf: could not open access log %s: %s" %
+                    (settings["access_log"], err))
+                return False
+        self.settings = settings
+        self.apply_settings(settings)
+        if changed.intersection(("root", "mime_types", "docindex_rescan", "docindex_inotify")):
+            # cached entries carry the filename and MIME type
+            self.stop_docindex()
+            self.docindex = self.new_docindex(settings)
+            self.start_docindex()
+            self.filecache.clear()
+            self.gzcache.clear()
+        else:
+            if "cache_max_file" in changed:
+                # entries that should or shouldn't hold a body now
+                self.filecache.clear()
+            elif "cache_revalidate" in changed and not self.docindex.watching():
+                self.filecache.revalidate = settings["cache_revalidate"]
+            if changed.intersection(("compressible", "gzip_max_file")):
+                self.gzcache.clear()
+                for entry in self.filecache.entries.values():
+                    entry.gzip = None
+        self.filecache.resize(settings["cache_bytes"])
+        self.gzcache.resize(settings["gzip_cache_bytes"])
+        # reopened on every reload so the log can be rotated; the old one
+        # is closed once the responses it has records for are sent
+        if self.access_log:
+            self.access_log.retire()
+        self.access_log = access_log
+        if self.access_log:
+            self.access_log.start()
+        self.reloads += 1
+        logging.warning("Reloaded web.conf%s" % (": " + ", ".join(sorted(changed)) if changed else ""))
+        return True
+
     def parse_conf_file(self):
         configs = []
         try:
@@ -301,9 +1612,8 @@ class Poller:
                 for line in conf_file:
                     if line != "\n":
                         configs.append(line[0:-1] if line.endswith("\n") else line)
-        except:
-            logging.error("Could not find 'web.conf'. Exiting...")
-            sys.exit(1)
+        except EnvironmentError as err:
+            raise ConfigError("Could not read 'web.conf': %s" % err)
         return configs
 
     def get_host(self, configs):
@@ -312,12 +1622,12 @@ class Poller:
 
     def get_root(self, configs):
         # set host and root
-        if configs[0].startswith("host"):
+        if configs and configs[0].startswith("host"):
             try:
                 return configs[0].split(' ')[2]    #return "web"...or whatever is in that position
-            except:
-                logging.error("Invalid HOST descriptor in web.conf.\n Usage: host [name] [path]\nExiting...")
-                sys.exit(1)
+            except IndexError:
+                pass
+        raise ConfigError("Invalid HOST descriptor in web.conf.\n Usage: host [name] [path]")
 
     def get_supportedMIMEtypes(self, configs):
         # set supported MIME types
@@ -325,12 +1635,45 @@ class Poller:
         for item in configs:
             if item.startswith("media"):
                 vals = item.split(' ')
+                if len(vals) < 3:
+                    raise ConfigError("Invalid media line in web.conf: %s" % item)
                 # types.append(vals[1])
                 types[vals[1]] = vals[2]
         return types
 
+    def get_compressible(self, configs):
+        # media lines ending in "gzip" may be compressed on the fly
+        types = set()
+        for item in configs:
+            if item.startswith("media"):
+                vals = item.split(' ')
+                if len(vals) > 3 and vals[3] == "gzip":
+                    types.add(vals[2])
+        return types
+
+    def get_wsgi_mounts(self, configs):
+        # wsgi lines look like "wsgi [prefix] [module:callable]"
+        mounts = []
+        for item in configs:
+            if item.startswith("wsgi "):
+                vals = item.split(' ')
+                if len(vals) < 3 or not vals[1].startswith("/"):
+                    raise ConfigError("Invalid wsgi line in web.conf: %s\n Usage: wsgi [prefix] [module:callable]" % item)
+                mounts.append((vals[1], vals[2]))
+        return mounts
+
     def get_timeout(self, configs):
+        return self.get_parameter(configs, "timeout", 1.0, float)
+
+    def get_parameter(self, configs, name, default, kind=int):
+        # parameter lines look like "parameter [name] [value]"
         for item in configs:
             if item.startswith("parameter"):
-                return int(item.split(' ')[2])
+                vals = item.split(' ')
+                if len(vals) > 2 and vals[1] == name:
+                    try:
+                        return kind(vals[2])
+                    except ValueError:
+                        raise ConfigError("Invalid value for parameter %s in web.conf: %s" % (name, vals[2]))
+        return default
 
@@ -0,0 +1,207 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import signal
+import socket
+import time
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# hot-path phases and the engine methods timed for them; build includes
+# lookup, since gen_response calls get_file
+PHASES = (("parse", "parse_request"), ("lookup", "get_file"), ("build", "gen_response"),
+    ("send", "send_response"))
+
+# what --profile serves: cached and gzipped files, a range from a large
+# file and a HEAD, pipelined on keep-alive connections
+WORKLOAD = (
+    b"GET /static/files/myfile.txt HTTP/1.1\r\nHost: localhost\r\n\r\n",
+    b"GET /index.html HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip\r\n\r\n",
+    b"GET /static/files/I-Have-A-Dream.pdf HTTP/1.1\r\nHost: localhost\r\n\r\n",
+    b"GET /static/files/largefile.txt HTTP/1.1\r\nHost: localhost\r\nRange: bytes=0-1023\r\n\r\n",
+    b"HEAD /static/files/test.txt HTTP/1.1\r\nHost: localhost\r\n\r\n",
+)
+
+class Profiler:
+    """ Where an engine spends its time. SIGUSR1 turns cProfile on and
+    off, SIGUSR2 does the same for the per-phase timers and loop lag; each
+    writes what it collected to profile_dir when it is turned off. Phases
+    are timed by wrapping the engine's methods on the instance while
+    tracing is on, so nothing is added to the hot path otherwise. """
+    def __init__(self, server):
+        self.server = server
+        self.profile = None
+        # phase -> [calls, seconds], None while tracing is off
+        self.phases = None
+        # [samples, total, max] of the loop lag while tracing
+        self.lag = None
+        self.traced = None
+        self.dumps = 0
+
+    def handle_signal(self, signum):
+        if signum == signal.SIGUSR1:
+            self.toggle_profile()
+        elif signum == signal.SIGUSR2:
+            self.toggle_tracing()
+
+    def toggle_profile(self):
+        if self.profile is None:
+            self.start_profile()
+        else:
+            self.stop_profile()
+
+    def toggle_tracing(self):
+        if self.phases is None:
+            self.start_tracing()
+        else:
+            self.stop_tracing()
+
+    def start_profile(self):
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        logging.warning("profiling started")
+
+    def stop_profile(self):
+        profile = self.profile
+        self.profile = None
+        profile.disable()
+        path = self.path("prof")
+        try:
+            profile.dump_stats(path)
+        except (IOError, OSError) as err:
+            logging.error("Could not write profile: %s" % err)
+            path = None
+        output = StringIO()
+        pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(20)
+        logging.warning("profile written to %s\n%s" % (path, output.getvalue()))
+
+    def start_tracing(self):
+        self.phases = {}
+        self.lag = [0, 0.0, 0.0]
+        self.traced = time.time()
+        for phase, name in PHASES:
+            totals = self.phases[phase] = [0, 0.0]
+            setattr(self.server, name, self.timed(getattr(self.server, name), totals))
+        logging.warning("phase tracing started")
+
+    def timed(self, method, totals):
+        def timed(*args, **kwargs):
+            started = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                totals[0] += 1
+                totals[1] += time.time() - started
+        return timed
+
+    def stop_tracing(self):
+        for phase, name in PHASES:
+            # the class's method shows through again
+            delattr(self.server, name)
+        report = self.report()
+        self.phases = None
+        self.lag = None
+        path = self.path("json")
+        try:
+            with open(path, "w") as report_file:
+                report_file.write(json.dumps(report, indent=2, sort_keys=True) + "\n")
+        except (IOError, OSError) as err:
+            logging.error("Could not write phase timings: %s" % err)
+            path = None
+        lines = ["%-8s %8i calls %10.3fs %10.1fus each" % (phase, timing["calls"], timing["seconds"],
+            timing["microseconds_per_call"]) for (phase, timing) in sorted(report["phases"].items())]
+        logging.warning("phase timings written to %s, over %.1fs:\n%s\nloop lag: mean %.6fs, max %.6fs" %
+            (path, report["seconds"], "\n".join(lines), report["loop_lag"]["mean"], report["loop_lag"]["max"]))
+
+    def add_lag(self, lag):
+        self.lag[0] += 1
+        self.lag[1] += lag
+        if lag > self.lag[2]:
+            self.lag[2] = lag
+
+    def report(self):
+        phases = {}
+        for phase, (calls, seconds) in self.phases.items():
+            phases[phase] = {"calls": calls, "seconds": seconds,
+                "microseconds_per_call": seconds / calls * 1000000 if calls else 0.0}
+        samples, total, longest = self.lag
+        return {"seconds": time.time() - self.traced, "phases": phases,
+            "loop_lag": {"samples": samples, "mean": total / samples if samples else 0.0, "max": longest}}
+
+    def stop(self):
+        """ Write out whatever is still being collected, e.g. on shutdown """
+        if self.profile is not None:
+            self.stop_profile()
+        if self.phases is not None:
+            self.stop_tracing()
+
+    def path(self, extension):
+        self.dumps += 1
+        return os.path.join(self.server.profile_dir, "webserver-%i-%i.%s" % (os.getpid(), self.dumps, extension))
+
+def read_responses(sock, requests):
+    """ Read the responses to requests, which all have a Content-Length """
+    data = b""
+    for request in requests:
+        while b"\r\n\r\n" not in data:
+            received = sock.recv(65536)
+            if not received:
+                raise IOError("connection closed with responses outstanding")
+            data += received
+        head, data = data.split(b"\r\n\r\n", 1)
+        length = 0
+        if not request.startswith(b"HEAD"):
+            for line in head.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":", 1)[1])
+        while len(data) < length:
+            received = sock.recv(65536)
+            if not received:
+                raise IOError("connection closed in a response body")
+            data += received
+        data = data[length:]
+
+def send_workload(port, rounds, connections, batch):
+    """ Each round opens the connections, pipelines a batch of requests on
+    each, then reads every response """
+    requests = [WORKLOAD[i % len(WORKLOAD)] for i in range(batch)]
+    for i in range(rounds):
+        socks = []
+        for j in range(connections):
+            sock = socket.create_connection(("127.0.0.1", port))
+            sock.sendall(b"".join(requests))
+            socks.append(sock)
+        for sock in socks:
+            read_responses(sock, requests)
+            sock.close()
+
+def benchmark(engine, args, rounds=50, connections=8, batch=50):
+    """ --profile: serve the fixed workload from a child process with
+    cProfile and phase tracing on, then write both out and exit """
+    server = engine(args)
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            send_workload(args.port, rounds, connections, batch)
+        except:
+            logging.exception("benchmark workload failed")
+            status = 1
+        # stops the server the same way Control-C does
+        os.kill(os.getppid(), signal.SIGINT)
+        os._exit(status)
+    started = time.time()
+    server.profiler.start_profile()
+    server.profiler.start_tracing()
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.profiler.stop()
+        os.waitpid(pid, 0)
+    logging.warning("benchmark: %i requests in %.2fs" % (rounds * connections * batch, time.time() - started))
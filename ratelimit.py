@@ -0,0 +1,45 @@
+import math
+
+class RateLimiter:
+    """ Token bucket per client address. Each client may send burst
+    requests at once, then rate a second. A bucket that has filled up
+    again is the same as no bucket, so those are pruned when the table
+    gets big. """
+    def __init__(self, rate, burst, max_clients=100000):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.max_clients = max_clients
+        # address -> [tokens, time they were counted]
+        self.buckets = {}
+
+    def allow(self, key, now):
+        """ Take a token for a request from key. Returns False if it has
+        none left. """
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_clients:
+                self.prune(now)
+            self.buckets[key] = [self.burst - 1, now]
+            return True
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def retry_after(self, key):
+        """ Whole seconds until key has a token again """
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return 0
+        return max(1, int(math.ceil((1 - bucket[0]) / self.rate)))
+
+    def prune(self, now):
+        refill = self.burst / self.rate
+        for key in [key for (key, bucket) in self.buckets.items() if now - bucket[1] >= refill]:
+            del self.buckets[key]
+        if len(self.buckets) >= self.max_clients:
+            # every client is busy; forgetting them only lets them burst again
+            self.buckets.clear()
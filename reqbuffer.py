@@ -0,0 +1,117 @@
+from connection import BODY, HEADER
+
+class RequestError(Exception):
+    """ A request that can't be handled; status is the response to send """
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+class RequestBuffer(object):
+    """ Incoming bytes for one connection. Data is received straight into a
+    bytearray and complete requests are found and consumed in place, in the
+    order they arrived. """
+    # one per connection, idle ones included
+    __slots__ = ("size", "data", "start", "end", "scanned", "max_header", "max_body")
+
+    def __init__(self, size, max_header, max_body):
+        self.size = size
+        # allocated on the first receive, see release()
+        self.data = b""
+        # first byte that hasn't been consumed by a request yet
+        self.start = 0
+        # end of the received data
+        self.end = 0
+        # where to resume looking for the end of the headers
+        self.scanned = 0
+        self.max_header = max_header
+        self.max_body = max_body
+
+    def empty(self):
+        return self.start == self.end
+
+    def partial(self):
+        """ What the incomplete request at the front of the buffer is still
+        missing, HEADER or BODY, or None if nothing is buffered. As of the
+        last next_request() call. """
+        if self.start == self.end:
+            return None
+        # next_request() stops scanning at the end of the headers once it
+        # has found them
+        return BODY if self.scanned < self.end else HEADER
+
+    def release(self):
+        """ Drop the storage of an empty buffer, so idle keep-alive
+        connections don't each hold one """
+        if self.start == self.end:
+            self.data = b""
+
+    def recv(self, sock):
+        """ Receive as much as fits into the buffer. Returns the byte count,
+        0 when the client closed the connection. """
+        if not self.data:
+            self.data = bytearray(self.size)
+        elif self.end == len(self.data):
+            self.make_room()
+        count = sock.recv_into(memoryview(self.data)[self.end:])
+        self.end += count
+        return count
+
+    def feed(self, data):
+        """ Append data that was received elsewhere, e.g. by a transport """
+        if not self.data:
+            self.data = bytearray(max(self.size, len(data)))
+        if len(self.data) - self.end < len(data):
+            self.make_room()
+            if len(self.data) - self.end < len(data):
+                self.data.extend(bytearray(len(data)))
+        self.data[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def make_room(self):
+        if self.start:
+            # move the unconsumed bytes to the front
+            pending = self.end - self.start
+            self.data[:pending] = self.data[self.start:self.end]
+            self.scanned -= self.start
+            self.start = 0
+            self.end = pending
+        if self.end == len(self.data):
+            self.data.extend(bytearray(len(self.data)))
+
+    def next_request(self):
+        """ Returns the next complete request (headers and body) as bytes and
+        consumes it, or None if it hasn't all arrived yet. """
+        index = self.data.find(b"\r\n\r\n", max(self.start, self.scanned - 3), self.end)
+        if index == -1:
+            self.scanned = self.end
+            if self.end - self.start > self.max_header:
+                raise RequestError("431 Request Header Fields Too Large")
+            return None
+        header_end = index + 4
+        if header_end - self.start > self.max_header:
+            raise RequestError("431 Request Header Fields Too Large")
+        length = self.content_length(self.start, index)
+        if length > self.max_body:
+            raise RequestError("413 Request Entity Too Large")
+        if header_end + length > self.end:
+            # wait for the rest of the body
+            self.scanned = index
+            return None
+        request = bytes(self.data[self.start:header_end + length])
+        self.start = header_end + length
+        self.scanned = self.start
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+        return request
+
+    def content_length(self, start, end):
+        headers = bytes(self.data[start:end]).lower()
+        index = headers.find(b"\r\ncontent-length:")
+        if index == -1:
+            return 0
+        index += len(b"\r\ncontent-length:")
+        line_end = headers.find(b"\r\n", index)
+        value = headers[index:line_end if line_end != -1 else len(headers)].strip()
+        if not value.isdigit():
+            raise RequestError("400 Bad Request")
+        return int(value)
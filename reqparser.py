@@ -0,0 +1,210 @@
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+from compat import to_str
+from reqbuffer import RequestError
+
+# parser states
+HEAD = 0
+BODY = 1
+DONE = 2
+
+class Headers(object):
+    """ Request headers as received. They are only split the first time one
+    is looked up, values stay bytes until asked for, and names are matched
+    case-insensitively. """
+    __slots__ = ("raw", "fields")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.fields = None
+
+    def decode(self):
+        fields = {}
+        for line in self.raw.split(b"\r\n"):
+            name, sep, value = line.partition(b":")
+            if not sep:
+                continue
+            name = to_str(name.strip()).lower()
+            value = value.strip()
+            # repeated headers are combined, as HTTP allows
+            fields[name] = fields[name] + b", " + value if name in fields else value
+        self.fields = fields
+        return fields
+
+    def get(self, name, default=None):
+        fields = self.fields if self.fields is not None else self.decode()
+        value = fields.get(name.lower())
+        return to_str(value) if value is not None else default
+
+    def __getitem__(self, name):
+        fields = self.fields if self.fields is not None else self.decode()
+        return to_str(fields[name.lower()])
+
+    def __contains__(self, name):
+        fields = self.fields if self.fields is not None else self.decode()
+        return name.lower() in fields
+
+    def __len__(self):
+        fields = self.fields if self.fields is not None else self.decode()
+        return len(fields)
+
+    def items(self):
+        fields = self.fields if self.fields is not None else self.decode()
+        return [(name, to_str(value)) for (name, value) in fields.items()]
+
+class RequestParser(object):
+    """ Incremental parser for the requests this server sees: GET and HEAD
+    with a handful of headers and, rarely, a Content-Length body.
+
+    It has the parts of HttpParser's interface the server uses, so either
+    can be selected. One parser is kept per connection and reset between
+    requests. Malformed or oversized requests raise RequestError with the
+    status to answer with. """
+    __slots__ = ("max_request_line", "max_header", "max_headers", "state", "head",
+        "scanned", "method", "url", "version", "headers", "length", "body", "path")
+
+    def __init__(self, max_request_line=8192, max_header=8192, max_headers=100):
+        self.max_request_line = max_request_line
+        self.max_header = max_header
+        self.max_headers = max_headers
+        self.reset()
+
+    def reset(self):
+        self.state = HEAD
+        # a head that arrived in pieces
+        self.head = b""
+        # how much of it has been searched for the blank line
+        self.scanned = 0
+        self.method = None
+        self.url = None
+        self.version = None
+        self.headers = None
+        self.length = 0
+        self.body = b""
+        self.path = None
+
+    def execute(self, data, length):
+        """ Parse up to length bytes of data. Returns how many were used,
+        which is less than length when the data runs past the end of this
+        request, e.g. into a pipelined one. """
+        if length < len(data):
+            data = data[:length]
+        used = 0
+        if self.state == HEAD:
+            if self.head:
+                start = len(self.head)
+                self.head += data
+                buf = self.head
+                end = buf.find(b"\r\n\r\n", max(0, self.scanned - 3))
+            else:
+                # the usual case, the whole head in one piece
+                start = 0
+                buf = data
+                end = buf.find(b"\r\n\r\n")
+            if end == -1:
+                self.check_partial(buf)
+                if buf is data:
+                    self.head = bytearray(data)
+                self.scanned = len(self.head)
+                return length
+            if end + 4 > self.max_header:
+                raise RequestError("431 Request Header Fields Too Large")
+            self.parse_head(bytes(buf[:end]))
+            used = end + 4 - start
+            self.head = b""
+            data = data[used:]
+            self.state = BODY if self.length else DONE
+        if self.state == BODY:
+            count = min(len(data), self.length - len(self.body))
+            self.body += bytes(data[:count])
+            used += count
+            if len(self.body) == self.length:
+                self.state = DONE
+        return used
+
+    def check_partial(self, buf):
+        """ Limits that can be enforced before the head is complete """
+        if len(buf) > self.max_request_line and buf.find(b"\r\n", 0, self.max_request_line + 2) == -1:
+            raise RequestError("414 Request-URI Too Long")
+        if len(buf) > self.max_header:
+            raise RequestError("431 Request Header Fields Too Large")
+
+    def parse_head(self, head):
+        # a stray CRLF before the request line is allowed
+        head = head.lstrip(b"\r\n")
+        line_end = head.find(b"\r\n")
+        if line_end == -1:
+            line_end = len(head)
+        if line_end > self.max_request_line:
+            raise RequestError("414 Request-URI Too Long")
+        parts = head[:line_end].split(b" ")
+        if len(parts) != 3 or not parts[0] or not parts[1] or parts[2] not in (b"HTTP/1.1", b"HTTP/1.0"):
+            raise RequestError("400 Bad Request")
+        self.method, self.url, self.version = parts
+        raw = head[line_end + 2:]
+        if raw.count(b"\r\n") + 1 > self.max_headers:
+            raise RequestError("431 Request Header Fields Too Large")
+        self.headers = Headers(raw)
+        # the two headers framing needs are found without decoding the rest
+        lower = b"\r\n" + raw.lower()
+        if b"\r\ntransfer-encoding:" in lower:
+            # chunked request bodies aren't supported
+            raise RequestError("411 Length Required")
+        index = lower.find(b"\r\ncontent-length:")
+        if index != -1:
+            index += len(b"\r\ncontent-length:")
+            line_end = lower.find(b"\r\n", index)
+            value = lower[index:line_end if line_end != -1 else len(lower)].strip()
+            if not value.isdigit():
+                raise RequestError("400 Bad Request")
+            self.length = int(value)
+
+    def get_method(self):
+        return to_str(self.method) if self.method is not None else None
+
+    def get_url(self):
+        return to_str(self.url) if self.url is not None else None
+
+    def get_path(self):
+        if self.path is None and self.url is not None:
+            url = to_str(self.url)
+            if url.startswith("/"):
+                self.path = url.split("?", 1)[0].split("#", 1)[0]
+            else:
+                # absolute form, "http://host/path"
+                self.path = urlparse(url).path
+        return self.path
+
+    def get_query_string(self):
+        if self.url is None:
+            return None
+        return to_str(self.url).partition("?")[2].partition("#")[0]
+
+    def get_version(self):
+        if self.version is None:
+            return None
+        return (1, 1) if self.version == b"HTTP/1.1" else (1, 0)
+
+    def get_headers(self):
+        return self.headers
+
+    def get_body(self):
+        return self.body
+
+    def recv_body(self):
+        """ The body, once, as HttpParser returns it """
+        body = self.body
+        self.body = b""
+        return body
+
+    def is_headers_complete(self):
+        return self.state != HEAD
+
+    def is_partial_body(self):
+        return self.state == BODY
+
+    def is_message_complete(self):
+        return self.state == DONE
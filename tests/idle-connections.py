@@ -0,0 +1,140 @@
+#
+# Memory used by idle keep-alive connections
+#
+# Opens connections to a running server in steps (10k and 50k by default),
+# optionally sends one request on each so it looks like a keep-alive client
+# between requests, and reports how much the server's resident memory grew
+# per connection. Needs Python 3.
+#
+# The server has to keep the connections open for the whole run, so give it
+# a long timeout first ("parameter timeout 600" in web.conf, then SIGHUP),
+# and enough descriptors for both processes (ulimit -n). Connections are
+# spread over several 127.0.0.x source addresses so 50k fit in the
+# ephemeral port range.
+
+import argparse
+import json
+import resource
+import socket
+import time
+
+def rss(pid):
+    """ Resident set size of a process, in bytes """
+    with open("/proc/%i/status" % pid) as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def kernel_tcp_bytes():
+    """ Memory the kernel has allocated to TCP buffers, all processes """
+    with open("/proc/net/sockstat") as sockstat:
+        for line in sockstat:
+            if line.startswith("TCP:"):
+                fields = line.split()
+                return int(fields[fields.index("mem") + 1]) * resource.getpagesize()
+    return 0
+
+def read_response(sock):
+    data = b""
+    while b"\r\n\r\n" not in data:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("closed by server")
+        data += chunk
+    head, _, body = data.partition(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    while len(body) < length:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("closed by server")
+        body += chunk
+
+class IdleClients:
+    def __init__(self, args):
+        self.args = args
+        self.sockets = []
+
+    def source(self):
+        # a different source address every per_source connections
+        if not self.args.host.startswith("127."):
+            return None
+        return ("127.0.0.%i" % (len(self.sockets) // self.args.per_source + 1), 0)
+
+    def open(self, count):
+        while len(self.sockets) < count:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            source = self.source()
+            if source:
+                sock.bind(source)
+            sock.connect((self.args.host, self.args.port))
+            if self.args.uri:
+                sock.sendall(("GET %s HTTP/1.1\r\nHost: %s\r\n\r\n" % (self.args.uri, self.args.host)).encode())
+                read_response(sock)
+            self.sockets.append(sock)
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='Idle Connections', description='Measure server memory per idle keep-alive connection, reported as JSON', add_help=True)
+    parser.add_argument('target', help='hostname[:port][/uri]; with a uri, one request is sent on each connection first')
+    parser.add_argument('-p', '--pid', type=int, required=True, help='pid of the server process that holds the connections')
+    parser.add_argument('-n', '--counts', type=str, default='10000,50000', help='comma-separated connection counts to measure at')
+    parser.add_argument('-s', '--settle', type=float, default=2, help='seconds to wait before measuring')
+    parser.add_argument('--per-source', type=int, default=20000, help='connections per 127.0.0.x source address')
+    parser.add_argument('-o', '--output', type=str, default=None, help='also write the JSON report to this file')
+    args = parser.parse_args(argv)
+
+    hostparts = args.target.split('/', 1)
+    portparts = hostparts[0].split(':')
+    args.host = portparts[0]
+    if args.host == "localhost":
+        args.host = "127.0.0.1"
+    args.port = int(portparts[1]) if len(portparts) > 1 else 8080
+    args.uri = '/' + hostparts[1] if len(hostparts) > 1 and hostparts[1] else None
+    args.counts = [int(count) for count in args.counts.split(',')]
+    return args
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    clients = IdleClients(args)
+    base_rss = rss(args.pid)
+    base_kernel = kernel_tcp_bytes()
+    steps = []
+    try:
+        for count in args.counts:
+            started = time.monotonic()
+            clients.open(count)
+            opened = time.monotonic() - started
+            time.sleep(args.settle)
+            grown = rss(args.pid) - base_rss
+            kernel = kernel_tcp_bytes() - base_kernel
+            steps.append({
+                "connections": count,
+                "open_seconds": opened,
+                "rss_growth": grown,
+                "bytes_per_connection": grown / float(count),
+                # both ends of every connection, for scale only
+                "kernel_tcp_growth": kernel,
+            })
+    finally:
+        clients.close()
+    report = {"target": args.target, "baseline_rss": base_rss, "steps": steps}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + "\n")
+    return report
+
+if __name__ == "__main__":
+    main()
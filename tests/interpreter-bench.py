@@ -0,0 +1,94 @@
+#
+# Throughput of the server under different Python interpreters
+#
+# Starts web.py under each interpreter in turn, loads it with
+# stress-test.py for a fixed time, and reports the requests per second
+# and latency each one reached, relative to the first. The same engine,
+# document and load are used for every run, so the difference is the
+# interpreter and what the code can use on it. Run from the repository
+# root or from tests/ with Python 3 (stress-test.py needs it); the servers
+# can be any version web.py runs on, e.g.
+#
+#   python3 tests/interpreter-bench.py -i python2.7,python3.9,python3.11
+#
+# Results are printed as JSON.
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def wait_for_port(port, timeout):
+    """ Wait until the server accepts connections """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+def version(interpreter):
+    output = subprocess.check_output([interpreter, "-c", "import sys; print(sys.version.split()[0])"],
+        stderr=subprocess.STDOUT)
+    return output.decode().strip()
+
+def run_one(interpreter, args):
+    """ Serve under one interpreter and load it; returns the stress test report """
+    server = subprocess.Popen([interpreter, "web.py", "-p", str(args.port), "-e", args.engine],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_port(args.port, 10):
+            raise RuntimeError("%s: server did not start on port %i" % (interpreter, args.port))
+        with tempfile.NamedTemporaryFile(suffix=".json") as report_file:
+            subprocess.check_call([sys.executable, os.path.join(ROOT, "tests", "stress-test.py"),
+                "127.0.0.1:%i%s" % (args.port, args.uri), "-c", str(args.connections),
+                "-d", str(args.duration), "-P", str(args.pipeline), "-o", report_file.name],
+                stdout=subprocess.DEVNULL)
+            with open(report_file.name) as data:
+                return json.load(data)
+    finally:
+        server.terminate()
+        server.wait()
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='Interpreter Benchmark', description='Compare server throughput across Python interpreters', add_help=True)
+    parser.add_argument('-i', '--interpreters', type=str, default='python2,python3', help='comma-separated interpreters to run web.py with; the first is the baseline')
+    parser.add_argument('-e', '--engine', choices=['epoll', 'asyncio'], default='epoll', help='event loop the server uses')
+    parser.add_argument('-p', '--port', type=int, default=8090, help='port the servers bind to, one at a time')
+    parser.add_argument('-u', '--uri', type=str, default='/static/files/myfile.txt', help='document every request asks for')
+    parser.add_argument('-c', '--connections', type=int, default=20, help='concurrent connections')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='seconds of load per interpreter')
+    parser.add_argument('-P', '--pipeline', type=int, default=1, help='requests pipelined on a connection at a time')
+    parser.add_argument('-o', '--output', type=str, default=None, help='also write the JSON report to this file')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    report = {"engine": args.engine, "uri": args.uri, "connections": args.connections,
+        "duration": args.duration, "pipeline": args.pipeline, "results": {}}
+    baseline = None
+    for interpreter in args.interpreters.split(','):
+        result = run_one(interpreter, args)
+        rate = result["requests_per_second"]
+        if baseline is None:
+            baseline = rate
+        report["results"][interpreter] = {"python": version(interpreter), "requests_per_second": rate,
+            "relative": rate / baseline if baseline else None, "errors": result["errors"],
+            "latency_ms": result["latency_ms"]}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + "\n")
+    return report
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#
+# Microbenchmark for the request parsers
+#
+# Feeds the same requests to the built-in RequestParser and to
+# http-parser's HttpParser (the C extension if it is installed, otherwise
+# its pure Python fallback, which the report names), in three shapes:
+#
+#   single      one request per call, as the server hands them over
+#   pipelined   a burst of requests received together, split by
+#               RequestBuffer and parsed one after another
+#   fragmented  requests arriving a few bytes at a time
+#
+# Run from the repository root or from tests/. Results are printed as JSON.
+
+import argparse
+import json
+import os
+import sys
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from reqbuffer import RequestBuffer
+from reqparser import RequestParser
+
+try:
+    from http_parser.parser import HttpParser
+    http_parser_kind = "c"
+except ImportError:
+    try:
+        from http_parser.pyparser import HttpParser
+        http_parser_kind = "python"
+    except ImportError:
+        HttpParser = None
+        http_parser_kind = None
+
+# what a browser sends for a static file
+REQUEST = (b"GET /static/files/myfile.txt HTTP/1.1\r\n"
+    b"Host: localhost:8080\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0\r\n"
+    b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    b"Accept-Language: en-US,en;q=0.5\r\n"
+    b"Accept-Encoding: gzip, deflate\r\n"
+    b"Connection: keep-alive\r\n"
+    b"If-Modified-Since: Tue, 15 Nov 1994 12:45:26 GMT\r\n"
+    b"\r\n")
+
+class BuiltinParsers:
+    """ One parser reused for every request, as on a connection """
+    name = "builtin"
+
+    def __init__(self):
+        self.parser = RequestParser()
+
+    def new(self):
+        self.parser.reset()
+        return self.parser
+
+class HttpParsers:
+    name = "http-parser"
+
+    def new(self):
+        return HttpParser()
+
+def use(parser):
+    # what handle_request looks at for a typical GET
+    headers = parser.get_headers()
+    parser.get_method()
+    parser.get_url()
+    headers.get("Range")
+    headers.get("Accept-Encoding")
+    headers.get("If-None-Match")
+    headers.get("If-Modified-Since")
+
+def single(parsers, count):
+    for i in range(count):
+        parser = parsers.new()
+        parser.execute(REQUEST, len(REQUEST))
+        use(parser)
+
+def pipelined(parsers, count, depth):
+    burst = REQUEST * depth
+    buf = RequestBuffer(len(burst), 8192, 1024 * 1024)
+    for i in range(count // depth):
+        buf.feed(burst)
+        while True:
+            req = buf.next_request()
+            if req is None:
+                break
+            parser = parsers.new()
+            parser.execute(req, len(req))
+            use(parser)
+
+def fragmented(parsers, count, size):
+    fragments = [REQUEST[i:i + size] for i in range(0, len(REQUEST), size)]
+    for i in range(count):
+        parser = parsers.new()
+        for fragment in fragments:
+            parser.execute(fragment, len(fragment))
+        # http-parser's Python fallback never marks a GET without a body
+        # as complete, so only the headers are checked
+        if not parser.is_headers_complete():
+            raise AssertionError("%s did not finish a fragmented request" % parsers.name)
+        use(parser)
+
+def measure(func, *args):
+    started = default_timer()
+    func(*args)
+    return default_timer() - started
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='Parser Benchmark', description='Compare the built-in request parser with http-parser', add_help=True)
+    parser.add_argument('-n', '--requests', type=int, default=50000, help='requests parsed per test')
+    parser.add_argument('-P', '--pipeline', type=int, default=16, help='requests per pipelined burst')
+    parser.add_argument('-f', '--fragment', type=int, default=16, help='bytes per fragment')
+    parser.add_argument('-o', '--output', type=str, default=None, help='also write the JSON report to this file')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    candidates = [BuiltinParsers()]
+    if HttpParser is not None:
+        candidates.append(HttpParsers())
+    report = {"requests": args.requests, "pipeline": args.pipeline, "fragment": args.fragment,
+        "http_parser": http_parser_kind, "python": sys.version.split()[0], "results": {}}
+    for parsers in candidates:
+        # warm up
+        single(parsers, 1000)
+        results = {}
+        for name, func, extra in (("single", single, ()),
+                ("pipelined", pipelined, (args.pipeline,)),
+                ("fragmented", fragmented, (args.fragment,))):
+            elapsed = measure(func, parsers, args.requests, *extra)
+            results[name] = {"seconds": elapsed, "requests_per_second": args.requests / elapsed,
+                "microseconds_per_request": elapsed / args.requests * 1000000}
+        report["results"][parsers.name] = results
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + "\n")
+    return report
+
+if __name__ == "__main__":
+    main()
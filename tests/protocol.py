@@ -1,10 +1,12 @@
+from __future__ import print_function
+
 import argparse
 import socket
 import sys
 
 class Tester:
     def __init__(self):
-        self.cache = ''
+        self.cache = b''
         self.size = 10000
 
     def parse_arguments(self):
@@ -30,18 +32,25 @@ class Tester:
         self.testNonBlocking()
         if self.extra:
             self.testRange()
+            self.testHeaderLimit()
+            self.testBodyLimit()
+            self.testMalformed()
+            self.testPipelining()
+            self.testRanges()
+            self.testHeadRequest()
+            self.testConditional()
 
     def testHeaders(self):
-        print "*** Headers ***"
-        print "Manually check that the Date, Server, Content-Length, Content-Type, and Last-Modified headers are present and have the right format"
-        print
+        print("*** Headers ***")
+        print("Manually check that the Date, Server, Content-Length, Content-Type, and Last-Modified headers are present and have the right format")
+        print()
         self.open_socket()
         self.send("GET / HTTP/1.1\r\nHost: %s\r\n\r\n" % self.host)
         self.get_response([200],check=True)
         self.close_socket()
 
     def testPersistent(self):
-        print "*** Persistent Connection ***"
+        print("*** Persistent Connection ***")
         self.open_socket()
         self.send("GET / HTTP/1.1\r\nHost: %s\r\n\r\n" % self.host)
         self.get_response([200],quiet=True)
@@ -54,35 +63,35 @@ class Tester:
         self.close_socket()
 
     def testBad(self):
-        print "*** Bad Request (400) ***"
+        print("*** Bad Request (400) ***")
         self.open_socket()
         self.send("BAD / HTTP/1.1\r\nHost: %s\r\n\r\n" % self.host)
         self.get_response([400,405,501])
         self.close_socket()
 
     def testNotFound(self):
-        print "*** Not Found (404) ***"
+        print("*** Not Found (404) ***")
         self.open_socket()
         self.send("GET /fjldsfjslf HTTP/1.1\r\nHost: %s\r\n\r\n" % self.host)
         self.get_response([404])
         self.close_socket()
 
     def testForbidden(self):
-        print "*** Forbidden (403) ***"
+        print("*** Forbidden (403) ***")
         self.open_socket()
         self.send("GET /static/files/test.txt HTTP/1.1\r\nHost: %s\r\n\r\n" % self.host)
         self.get_response([403])
         self.close_socket()
 
     def testNotImplemented(self):
-        print "*** Not Implemented (501) ***"
+        print("*** Not Implemented (501) ***")
         self.open_socket()
         self.send("DELETE / HTTP/1.1\r\nHost: %s\r\n\r\n" % self.host)
         self.get_response([501,405])
         self.close_socket()
 
     def testNonBlocking(self):
-        print "*** Partial Data and Non-Blocking I/O ***"
+        print("*** Partial Data and Non-Blocking I/O ***")
         self.open_socket()
         # send part of a request on first socket
         self.send("GET")
@@ -102,65 +111,170 @@ class Tester:
 
     def testRange(self):
         import requests
-        print "*** HEAD ***"
+        print("*** HEAD ***")
         r = requests.head('http://%s:%s/static/files/largefile.txt' % (self.host,self.port))
         if r.status_code != 200:
-            print "FAILED: Expected 200, got",r.status_code
-        print "*** Range Request ***"
+            print("FAILED: Expected 200, got", r.status_code)
+        print("*** Range Request ***")
         headers = {'Range':'bytes=0-999','Accept-Encoding': 'identity'}
         r = requests.get('http://%s:%s/static/files/largefile.txt' % (self.host,self.port),headers=headers)
         if r.status_code != 206:
-            print "FAILED: Expected 206, got",r.status_code
+            print("FAILED: Expected 206, got", r.status_code)
             return
         if len(r.content) != 1000:
-            print "FAILED: Expected 1000 bytes, got",len(r.content)
+            print("FAILED: Expected 1000 bytes, got", len(r.content))
+            return
+        print("PASSED")
+
+    def testHeaderLimit(self):
+        print("*** Header Fields Too Large (431) ***")
+        self.open_socket()
+        self.send("GET / HTTP/1.1\r\nHost: %s\r\nX-Filler: %s\r\n\r\n" % (self.host, "a" * 9000))
+        self.get_response([431])
+        self.close_socket()
+
+    def testBodyLimit(self):
+        print("*** Request Entity Too Large (413) ***")
+        self.open_socket()
+        self.send("POST / HTTP/1.1\r\nHost: %s\r\nContent-Length: 999999999\r\n\r\n" % self.host)
+        self.get_response([413])
+        self.close_socket()
+
+    def testMalformed(self):
+        print("*** Malformed Request (400) ***")
+        self.open_socket()
+        self.send("GET / HTTP/1.1\r\nHost: %s\r\nContent-Length: ten\r\n\r\n" % self.host)
+        self.get_response([400])
+        self.close_socket()
+        self.open_socket()
+        self.send("GET /index.html\r\nHost: %s\r\n\r\n" % self.host)
+        self.get_response([400,501])
+        self.close_socket()
+
+    def testPipelining(self):
+        print("*** Pipelined Requests ***")
+        self.open_socket()
+        self.send("GET /static/files/myfile.txt HTTP/1.1\r\nHost: %s\r\n\r\n"
+            "GET /fjldsfjslf HTTP/1.1\r\nHost: %s\r\n\r\n"
+            "HEAD / HTTP/1.1\r\nHost: %s\r\n\r\n"
+            "GET /static/files/test.txt HTTP/1.1\r\nHost: %s\r\nRange: bytes=0-4\r\n\r\n" % ((self.host,) * 4))
+        responses = [self.read_response(), self.read_response(), self.read_response(head=True), self.read_response()]
+        self.close_socket()
+        statuses = [status for status, headers, body in responses]
+        if statuses != [200, 404, 200, 206]:
+            print("FAILED: expected [200, 404, 200, 206] got", statuses)
+        elif responses[0][2] != b"Hello World! How art thou?\n\n" or len(responses[3][2]) != 5:
+            print("FAILED: responses out of order")
+        else:
+            print("PASSED")
+
+    def testRanges(self):
+        print("*** Partial Content (206, 416) ***")
+        self.open_socket()
+        self.send("GET /static/files/myfile.txt HTTP/1.1\r\nHost: %s\r\nRange: bytes=0-9\r\n\r\n" % self.host)
+        status, headers, body = self.read_response()
+        if status != 206 or self.get_header(headers, 'Content-Range') != 'bytes 0-9/28' or body != b"Hello Worl":
+            print("FAILED: expected 206 with bytes 0-9/28, got", status, self.get_header(headers, 'Content-Range'), body)
+            self.close_socket()
+            return
+        self.send("GET /static/files/myfile.txt HTTP/1.1\r\nHost: %s\r\nRange: bytes=-5\r\n\r\n" % self.host)
+        status, headers, body = self.read_response()
+        if status != 206 or self.get_header(headers, 'Content-Range') != 'bytes 23-27/28' or len(body) != 5:
+            print("FAILED: expected 206 with bytes 23-27/28, got", status, self.get_header(headers, 'Content-Range'), body)
+            self.close_socket()
+            return
+        self.send("GET /static/files/myfile.txt HTTP/1.1\r\nHost: %s\r\nRange: bytes=1000-\r\n\r\n" % self.host)
+        status, headers, body = self.read_response()
+        self.close_socket()
+        if status != 416 or self.get_header(headers, 'Content-Range') != 'bytes */28':
+            print("FAILED: expected 416 with bytes */28, got", status, self.get_header(headers, 'Content-Range'))
+            return
+        print("PASSED")
+
+    def testHeadRequest(self):
+        print("*** HEAD Without a Body ***")
+        self.open_socket()
+        self.send("HEAD /static/files/myfile.txt HTTP/1.1\r\nHost: %s\r\n\r\n" % self.host)
+        status, headers, body = self.read_response(head=True)
+        # a body sent anyway would be read as the start of the next response
+        self.send("GET /static/files/myfile.txt HTTP/1.1\r\nHost: %s\r\n\r\n" % self.host)
+        next_status, next_headers, next_body = self.read_response()
+        self.close_socket()
+        if status != 200 or self.get_length(headers) != 28:
+            print("FAILED: expected 200 with Content-Length 28, got", status, self.get_length(headers))
+        elif next_status != 200 or next_body != b"Hello World! How art thou?\n\n":
+            print("FAILED: HEAD response was followed by a body")
+        else:
+            print("PASSED")
+
+    def testConditional(self):
+        print("*** Not Modified (304) ***")
+        self.open_socket()
+        self.send("GET /static/files/myfile.txt HTTP/1.1\r\nHost: %s\r\n\r\n" % self.host)
+        status, headers, body = self.read_response()
+        etag = self.get_header(headers, 'ETag')
+        if not etag:
+            print("FAILED: No ETag header")
+            self.close_socket()
+            return
+        self.send("GET /static/files/myfile.txt HTTP/1.1\r\nHost: %s\r\nIf-None-Match: %s\r\n\r\n" % (self.host, etag))
+        status, headers, body = self.read_response(head=True)
+        if status != 304 or self.get_header(headers, 'ETag') != etag:
+            print("FAILED: expected 304 with the same ETag, got", status, self.get_header(headers, 'ETag'))
+            self.close_socket()
+            return
+        self.send("GET /static/files/myfile.txt HTTP/1.1\r\nHost: %s\r\nIf-None-Match: \"other\"\r\n\r\n" % self.host)
+        status, headers, body = self.read_response()
+        self.close_socket()
+        if status != 200 or len(body) != 28:
+            print("FAILED: expected 200 for a different ETag, got", status)
             return
-        print "PASSED"
+        print("PASSED")
 
     def send(self,message):
-        self.server.sendall(message)
+        self.server.sendall(message.encode('latin-1'))
 
     def get_response(self,codes,check=False,quiet=False):
         ''' Check if response code is what was expected '''
         headers = self.read_headers()
         if self.verbose or check:
-            print headers,
+            print(headers, end='')
         entity = self.read_entity(headers)
         if not entity:
             return
         if not self.check_headers(headers,'Date'):
-            print "FAILED: No Date header"
+            print("FAILED: No Date header")
             return
         if not self.check_headers(headers,'Server'):
-            print "FAILED: No Server header"
+            print("FAILED: No Server header")
             return
         if not self.check_headers(headers,'Content-Type'):
-            print "FAILED: No Content-Type header"
+            print("FAILED: No Content-Type header")
             return
         if not self.check_headers(headers,'Content-Length'):
-            print "FAILED: No Content-Length header"
+            print("FAILED: No Content-Length header")
             return
         lines = headers.split('\r\n')
         first = lines[0].split()
         if int(first[1]) not in codes:
-            print "FAILED: expected",codes,"got",first[1]
+            print("FAILED: expected", codes, "got", first[1])
         else:
             if quiet:
                 return
-            print "PASSED"
+            print("PASSED")
 
     ### Opening and closing socket ###
 
     def open_socket(self):
         """ Connect to the server """
-        self.cache = ''
+        self.cache = b''
         try:
             self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server.connect((self.host,self.port))
-        except socket.error, (value,message):
+        except socket.error as err:
             if self.server:
                 self.server.close()
-            print "Could not open socket: " + message
+            print("Could not open socket: %s" % err)
             sys.exit(1)
 
     def close_socket(self):
@@ -173,20 +287,38 @@ class Tester:
             data = self.server.recv(self.size)
             if not data:
                 response = self.cache
-                self.cache = ''
-                return response
+                self.cache = b''
+                return response.decode('latin-1')
             self.cache += data
             headers = self.get_headers()
             if not headers:
                 continue
             return headers
 
+    def read_response(self,head=False):
+        ''' Read one response, returns (status, headers, body). Responses
+        to HEAD and 304s have no body, whatever their Content-Length says '''
+        # pipelined responses may have arrived already
+        headers = self.get_headers() or self.read_headers()
+        if not headers:
+            return None, '', b''
+        status = int(headers.split()[1])
+        length = 0 if head or status == 304 else (self.get_length(headers) or 0)
+        while len(self.cache) < length:
+            data = self.server.recv(self.size)
+            if not data:
+                break
+            self.cache += data
+        body = self.cache[:length]
+        self.cache = self.cache[length:]
+        return status, headers, body
+
     def read_bytes(self,length):
         while len(self.cache) < length:
             data = self.server.recv(self.size)
             if not data:
-                self.cache = ''
-                print "FAILED: Length of entity doesn't match Content-Length"
+                self.cache = b''
+                print("FAILED: Length of entity doesn't match Content-Length")
                 return False
             self.cache += data
         self.cache = self.cache[length:]
@@ -194,10 +326,10 @@ class Tester:
 
     def get_headers(self):
         ''' Check if headers present in cache '''
-        index = self.cache.find("\r\n\r\n")
+        index = self.cache.find(b"\r\n\r\n")
         if index == -1:
             return None
-        headers = self.cache[0:index+4]
+        headers = self.cache[0:index+4].decode('latin-1')
         self.cache = self.cache[index+4:]
         return headers
 
@@ -205,7 +337,7 @@ class Tester:
         ''' Read entity body '''
         length = self.get_length(headers)
         if not length:
-            print "FAILED: No Content-Length header"
+            print("FAILED: No Content-Length header")
             return False
         return self.read_bytes(length)
 
@@ -224,6 +356,16 @@ class Tester:
                 return length
         return None
 
+    def get_header(self,headers,expected):
+        ''' Get the value of a header, or None '''
+        for line in headers.split('\r\n')[1:]:
+            if ':' not in line:
+                continue
+            name, value = line.split(':',1)
+            if name.lower() == expected.lower():
+                return value.strip()
+        return None
+
     def check_headers(self,headers,expected):
         lines = headers.split('\r\n')
         for line in lines:
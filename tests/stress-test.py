@@ -1,139 +1,219 @@
-# 
+#
 # Stress test for web servers
 #	by Brian Sanderson
 #	February 2006
 #
 #   Revised by Daniel Zappala
 #   2007, 2008, 2013
+#
+#   Rewritten as an asyncio load generator. Needs Python 3.7 or later.
+#
+# Closed-loop mode keeps a fixed number of connections busy; open-loop mode
+# sends requests at a fixed rate whether or not earlier ones have finished,
+# and measures latency from when each request was due so a slow server
+# can't hide its queueing delay. Results are printed as JSON.
 
-import httplib
+import argparse
+import asyncio
+import json
 import math
-import optparse
 import random
-import socket
-import sys
 import time
-from threading import Thread
 
-class RequesterThread(Thread):
-    def __init__(self, host, port, uri, duration, identifier):
-        Thread.__init__(self)
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.bytes = 0
+
+    def add(self, status, length, latency):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes += length
+        self.latencies.append(latency)
+
+    def percentile(self, latencies, p):
+        if not latencies:
+            return None
+        index = max(0, int(math.ceil(p / 100.0 * len(latencies))) - 1)
+        return latencies[index] * 1000
+
+    def report(self, args, elapsed):
+        latencies = sorted(self.latencies)
+        return {
+            "mode": "open" if args.rate else "closed",
+            "connections": args.connections,
+            "rate": args.rate,
+            "pipeline": args.pipeline,
+            "keepalive": not args.no_keepalive,
+            "duration": elapsed,
+            "requests": len(latencies),
+            "errors": self.errors,
+            "statuses": self.statuses,
+            "requests_per_second": len(latencies) / elapsed,
+            "mbps": 8 * self.bytes / elapsed / 1000000,
+            "latency_ms": {
+                "p50": self.percentile(latencies, 50),
+                "p90": self.percentile(latencies, 90),
+                "p99": self.percentile(latencies, 99),
+                "p99.9": self.percentile(latencies, 99.9),
+                "max": latencies[-1] * 1000 if latencies else None,
+                "mean": sum(latencies) / len(latencies) * 1000 if latencies else None,
+            },
+        }
+
+class Connection:
+    """ One client connection; requests on it may be pipelined """
+    def __init__(self, host, port, keepalive):
         self.host = host
         self.port = port
-        self.uri = uri
-        self.duration = duration
-        self.identifier = identifier
-		
-    def run(self):
-        result = True
-        error = ''
-        start_time = time.time()
-
-        conn = httplib.HTTPConnection(self.host, self.port)
-
-        num = 0
-        while result and ((time.time() - start_time) < self.duration):
-            buflen = 0
+        self.keepalive = keepalive
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def request(self, uris):
+        """ Send the requests back to back, then read the responses in
+        order. Returns a list of (status, body length, finish time). """
+        await self.open()
+        header = "Connection: keep-alive" if self.keepalive else "Connection: close"
+        self.writer.write("".join("GET %s HTTP/1.1\r\nHost: %s\r\n%s\r\n\r\n" % (uri, self.host, header)
+            for uri in uris).encode())
+        results = []
+        for uri in uris:
+            head = await self.reader.readuntil(b"\r\n\r\n")
+            lines = head.split(b"\r\n")
+            status = int(lines[0].split()[1])
+            length = 0
+            for line in lines[1:]:
+                name, _, value = line.partition(b":")
+                if name.strip().lower() == b"content-length":
+                    length = int(value)
+            await self.reader.readexactly(length)
+            results.append((status, len(head) + length, time.monotonic()))
+        if not self.keepalive:
+            self.close()
+        return results
+
+class LoadGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.stats = Stats()
+        self.random = random.Random(args.seed)
+        if args.uri:
+            self.uris = [args.uri]
+        else:
+            # the Pareto-sized set made by tests/files.py
+            self.uris = ["/file%03d.txt" % i for i in range(args.files)]
+
+    def next_uris(self, count):
+        return [self.random.choice(self.uris) for i in range(count)]
+
+    async def closed_loop(self, deadline):
+        """ Keep one batch of requests outstanding on each connection """
+        connection = Connection(self.args.host, self.args.port, not self.args.no_keepalive)
+        while time.monotonic() < deadline:
+            started = time.monotonic()
             try:
-                exp_start = time.time()
-                conn.request("GET", self.uri, None, {'X-Stress':'%d-%d' % (self.identifier,num)})
-                num += 1
-                resp = conn.getresponse()
-                if int(resp.status) != 200:
-                    error = '(Status = %d)' % (resp.status)
-                    result = False
-                else:
-                    givenlength = resp.getheader('content-length')
-                    mimetype = resp.getheader('content-type')
-                    if not givenlength:
-                        error = '(No content-length given)'
-                        result = False
-                    elif not givenlength.isdigit():
-                        error = '(Invalid content-length)'
-                        result = False
-                    else:
-                        givenlength = int(givenlength)
-
-                        buflen = 0
-                        while True:
-                            buf = resp.read(65000)
-                            if len(buf) > 0:
-                                buflen += len(buf)
-                            else:
-                            	error = "(Expected %d bytes got %d bytes)" % (givenlength,buflen)
-                                result = False
-                                break
-                            if buflen >= givenlength:
-                                break
-
-            except:
-                error = sys.exc_info()[1]
-                result = False
-            elapsedtime = time.time() - exp_start
-            if buflen == 0 or elapsedtime == 0:
-                throughput = 0.00
-            else:
-                throughput = (8*buflen / elapsedtime)
-            if throughput >  1000000:
-                throughput = throughput / 1000000
-                units = "Mbps"
-            else:
-                throughput = throughput / 1000
-                units = "Kbps"
-            print " Thread %d finished download %d in %5.2f sec, throughput = %6.2f (%s)" % (self.identifier,num-1,elapsedtime,throughput,units),
-            if result:
-                print "[OK]"
+                results = await connection.request(self.next_uris(self.args.pipeline))
+            except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                self.stats.errors += 1
+                connection.close()
+                continue
+            for status, length, finished in results:
+                self.stats.add(status, length, finished - started)
+        connection.close()
+
+    async def open_loop(self, deadline):
+        """ Issue requests at a fixed rate over a pool of connections """
+        idle = []
+        tasks = set()
+        interval = self.args.pipeline / float(self.args.rate)
+        start = time.monotonic()
+        sent = 0
+        while True:
+            due = start + sent * interval
+            if due >= deadline:
+                break
+            await asyncio.sleep(max(0, due - time.monotonic()))
+            if idle:
+                connection = idle.pop()
+            elif len(tasks) < self.args.connections:
+                connection = Connection(self.args.host, self.args.port, not self.args.no_keepalive)
             else:
-                print "[FAILED]", error
-            sys.stdout.flush()
-
-class WorkloadGenerator:
-    def __init__(self, hostname, port, uri, num_threads, duration):
-        self.threads = []
-        self.hostname = hostname
-        self.port = 80
-        self.uri = uri
-        identifier = 0
-        for i in range(num_threads):
-            self.threads.append(RequesterThread(hostname, port, uri, duration, identifier))
-            identifier += 1
-        self.duration = duration
-		
-    def launch_requesters(self):
-        for thread in self.threads:
-            time.sleep(0.1)
-            thread.start()
-        time.sleep(self.duration)
-        print "Waiting for thread termination ..."
-        for thread in self.threads:
-            thread.join()
-			
-if __name__ == "__main__":
-    parser = optparse.OptionParser(usage="%prog hostname[:port]/file -t [threads] -d [duration]", version="%prog 1.0")
-    parser.add_option("-t", "--threads", dest="threads", type="int", default=1,
-                      help=	"number of busy threads to test")
-    parser.add_option("-d", "--duration", dest="duration", type="int", default=30,
-                      help=	"duration of test")
-    (options, args) = parser.parse_args()
-
-    # check for host:port/file
-    if len(args) < 1:
-        parser.error("You must specifiy a host:port/file argument.")
-    hostparts = args[0].split('/')
+                # every connection is busy, the server is not keeping up
+                self.stats.errors += 1
+                sent += 1
+                continue
+            task = asyncio.ensure_future(self.issue(connection, due, idle))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            sent += 1
+        if tasks:
+            await asyncio.wait(tasks)
+        for connection in idle:
+            connection.close()
+
+    async def issue(self, connection, due, idle):
+        try:
+            results = await connection.request(self.next_uris(self.args.pipeline))
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            self.stats.errors += 1
+            connection.close()
+            return
+        for status, length, finished in results:
+            # measured from when the request was due, not when it was sent
+            self.stats.add(status, length, finished - due)
+        idle.append(connection)
+
+    async def run(self):
+        start = time.monotonic()
+        deadline = start + self.args.duration
+        if self.args.rate:
+            await self.open_loop(deadline)
+        else:
+            await asyncio.gather(*[self.closed_loop(deadline) for i in range(self.args.connections)])
+        return self.stats.report(self.args, time.monotonic() - start)
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='Stress Test', description='Load generator for web servers, reports latency percentiles and throughput as JSON', add_help=True)
+    parser.add_argument('target', help='hostname[:port][/uri]; without a uri, requests are spread over the www/fileNNN.txt set')
+    parser.add_argument('-c', '--connections', type=int, default=10, help='concurrent connections (closed loop), or the pool size (open loop)')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='requests per second for open-loop mode; closed loop if not given')
+    parser.add_argument('-d', '--duration', type=float, default=30, help='duration of test in seconds')
+    parser.add_argument('-P', '--pipeline', type=int, default=1, help='requests pipelined on a connection at a time')
+    parser.add_argument('-k', '--no-keepalive', action='store_true', help='open a new connection for every batch of requests')
+    parser.add_argument('-f', '--files', type=int, default=1000, help='number of files in the www set')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='random seed for choosing files')
+    parser.add_argument('-o', '--output', type=str, default=None, help='also write the JSON report to this file')
+    args = parser.parse_args(argv)
+
+    # check for host:port/uri
+    hostparts = args.target.split('/', 1)
     portparts = hostparts[0].split(':')
-    hostname = portparts[0]
-    uri = '/' + '/'.join(hostparts[1:])
-    port = 80
-		
-    if (len(portparts) > 1):
-        port = int(portparts[1])
-				
-    print "Host: %s, Port: %d, URI: %s" % (hostname, port, uri)
-    print "Number of concurrently busy threads: %d" % (int(options.threads))
-    print "Duration of test:                  : %d sec" % (int(options.duration))
-    print "--------------------------------------------------------"
-        
-    # launch generators
-    generator = WorkloadGenerator(hostname, port, uri, int(options.threads),
-                                  int(options.duration))
-    generator.launch_requesters()
+    args.host = portparts[0]
+    args.port = int(portparts[1]) if len(portparts) > 1 else 8080
+    args.uri = '/' + hostparts[1] if len(hostparts) > 1 and hostparts[1] else None
+    return args
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    generator = LoadGenerator(args)
+    report = asyncio.run(generator.run())
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + "\n")
+    return report
+
+if __name__ == "__main__":
+    main()
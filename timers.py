@@ -0,0 +1,64 @@
+import heapq
+
+class Timers:
+    """ Deadlines kept in a min-heap with lazy deletion. Pushing a deadline
+    back only updates a dict; the heap entry is moved when it comes due. """
+    def __init__(self):
+        self.heap = []
+        # the live heap entry for each key
+        self.entries = {}
+        # the current deadline for each key
+        self.deadlines = {}
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def set(self, key, deadline):
+        self.deadlines[key] = deadline
+        entry = self.entries.get(key)
+        if entry is None or deadline < entry[0]:
+            # a new key, or a deadline earlier than its heap entry
+            entry = [deadline, key]
+            self.entries[key] = entry
+            heapq.heappush(self.heap, entry)
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+        self.entries.pop(key, None)
+
+    def next_deadline(self):
+        """ Returns the nearest deadline, or None if there are no timers """
+        while self.heap:
+            entry = self.heap[0]
+            if self.settle(entry):
+                return entry[0]
+        return None
+
+    def expired(self, now):
+        """ Removes and returns the keys whose deadlines have passed """
+        keys = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = self.heap[0]
+            if self.settle(entry):
+                heapq.heappop(self.heap)
+                key = entry[1]
+                del self.entries[key]
+                del self.deadlines[key]
+                keys.append(key)
+        return keys
+
+    def settle(self, entry):
+        """ Check the entry at the top of the heap. Returns True if it is
+        live and up to date, otherwise drops or reschedules it. """
+        deadline, key = entry
+        if self.entries.get(key) is not entry:
+            # cancelled, or replaced by an earlier deadline
+            heapq.heappop(self.heap)
+            return False
+        if self.deadlines[key] > deadline:
+            # pushed back since it was scheduled, move it to the new deadline
+            entry = [self.deadlines[key], key]
+            self.entries[key] = entry
+            heapq.heapreplace(self.heap, entry)
+            return False
+        return True
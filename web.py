@@ -6,7 +6,9 @@ Control-C will quit the server.
 import argparse
 import logging
 
+from master import Master
 from poller import Poller
+from profiler import benchmark
 
 class Main:
     """ Parse command line options and perform the download. """
@@ -18,6 +20,10 @@ class Main:
         parser = argparse.ArgumentParser(prog='Echo Server', description='A simple echo server that handles one client at a time', add_help=True)
         parser.add_argument('-p', '--port', type=int, action='store', help='port the server will bind to',default=8080)
         parser.add_argument('-d', '--debug', action='store_true', help='use debug mode')
+        parser.add_argument('-w', '--workers', type=int, action='store', help='number of worker processes to fork',default=1)
+        parser.add_argument('-e', '--engine', choices=['epoll', 'asyncio'], action='store', help='event loop to serve clients with',default='epoll')
+        parser.add_argument('--parser', choices=['builtin', 'http-parser'], action='store', help='HTTP request parser to use',default='builtin')
+        parser.add_argument('--profile', action='store_true', help='serve a fixed benchmark workload under the profiler, write the stats and exit')
         self.args = parser.parse_args()
 
     def run(self):
@@ -25,9 +31,24 @@ class Main:
             logging.basicConfig(level=logging.DEBUG)
         else:
             logging.basicConfig(level=logging.WARN)
-        p = Poller(self.args)
+        engine = self.get_engine()
+        if self.args.profile:
+            benchmark(engine, self.args)
+            return
+        if self.args.workers > 1:
+            m = Master(self.args, engine)
+            m.run()
+            return
+        p = engine(self.args)
         p.run()
 
+    def get_engine(self):
+        if self.args.engine == 'asyncio':
+            # asyncio is only available on python 3
+            from aioserver import AsyncioServer
+            return AsyncioServer
+        return Poller
+
 if __name__ == "__main__":
     m = Main()
     m.parse_arguments()
@@ -0,0 +1,131 @@
+import importlib
+import itertools
+import logging
+import sys
+from io import BytesIO
+try:
+    from urllib import unquote
+except ImportError:
+    from urllib.parse import unquote as unquote_utf8
+
+    def unquote(path):
+        # PEP 3333 native strings carry the raw bytes as latin-1
+        return unquote_utf8(path, encoding="latin-1")
+
+# connection-level headers, the server sets these itself
+HOP_HEADERS = frozenset(("connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade", "date", "server"))
+
+def load_app(spec):
+    """ Import an application given as "module:callable" """
+    module_name, sep, name = spec.partition(":")
+    module = importlib.import_module(module_name)
+    return getattr(module, name or "application")
+
+class ResponseBody:
+    """ A response body to stream: the buffers already taken from the
+    application, then the rest of its iterable, which close() closes """
+    def __init__(self, first, iterator, iterable):
+        self.iterator = itertools.chain(first, iterator)
+        self.iterable = iterable
+
+    def __iter__(self):
+        return self.iterator
+
+    def close(self):
+        close = getattr(self.iterable, "close", None)
+        if close:
+            close()
+
+class WsgiApp:
+    """ A WSGI application mounted at a URL prefix. The environ is built on
+    the loop; the application is called on a pool thread, which returns
+    once the status is known and the first of the body is ready. The rest
+    of the body is made on the pool too, a buffer at a time as the client
+    takes it. """
+    def __init__(self, prefix, spec):
+        # "/" mounts at the root
+        self.prefix = prefix.rstrip("/")
+        self.spec = spec
+        self.app = load_app(spec)
+
+    def matches(self, path):
+        return path == self.prefix or path.startswith(self.prefix + "/")
+
+    def environ(self, method, path, query, headers, body, version, server, remote, multiprocess):
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": self.prefix,
+            "PATH_INFO": unquote(path[len(self.prefix):]),
+            "QUERY_STRING": query or "",
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": "HTTP/%i.%i" % version,
+            "REMOTE_ADDR": remote[0],
+            "REMOTE_PORT": str(remote[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": multiprocess,
+            "wsgi.run_once": False,
+        }
+        for name, value in headers.items():
+            key = name.upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            environ[key] = environ[key] + "," + value if key in environ else value
+        return environ
+
+    def call(self, environ):
+        """ Run the application, on a pool thread. Returns (status, headers,
+        body), where body is either the whole body as a list of buffers or
+        a ResponseBody to stream. """
+        response = []
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if response and not exc_info:
+                raise AssertionError("start_response called twice without exc_info")
+            # nothing has been sent before call() returns, so an error
+            # response can always replace the first one
+            response[:] = [status, headers]
+            return written.append
+
+        try:
+            iterable = self.app(environ, start_response)
+            # write() output comes before the iterable's
+            body = written
+            streamed = False
+            try:
+                if isinstance(iterable, (list, tuple)):
+                    body.extend(iterable)
+                else:
+                    iterator = iter(iterable)
+                    # headers wait for the first buffer, start_response may
+                    # be called from inside a generator
+                    for data in iterator:
+                        if data:
+                            body.append(data)
+                            streamed = True
+                            break
+                if not response:
+                    raise RuntimeError("application did not call start_response")
+                if not response[0][:3].isdigit() or response[0][3:4] != " ":
+                    raise ValueError("invalid status %r" % response[0])
+                for data in body:
+                    if not isinstance(data, bytes):
+                        raise TypeError("application returned %s, not bytes" % type(data).__name__)
+            except Exception:
+                if hasattr(iterable, "close"):
+                    iterable.close()
+                raise
+            if streamed:
+                body = ResponseBody(body, iterator, iterable)
+            elif hasattr(iterable, "close"):
+                iterable.close()
+        except Exception:
+            logging.exception("WSGI application %s failed" % self.spec)
+            raise
+        return response[0], response[1], body